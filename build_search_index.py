@@ -0,0 +1,86 @@
+"""
+Builds (or incrementally updates) the explorer's full-text search index of messages and commands.
+
+Only instances that are new or whose files changed since they were last indexed are (re)indexed; instances that no
+longer exist are removed.
+
+Usage: python build_search_index.py [-d DATA_DIR] [-o INDEX_PATH] [--rebuild]
+"""
+import argparse
+import logging
+import pathlib
+
+import tqdm
+import tqdm.contrib.concurrent
+import tqdm.contrib.logging
+
+from dataset.search_index import SearchIndex, extract_instance_rows, instance_signature
+from dataset.utils import get_combat_dirs
+
+SEARCH_INDEX_PATH = pathlib.Path("extract/search_index.sqlite3")
+RUN_PARALLEL = True
+# instances are extracted in parallel a batch at a time, so only one batch of rows is held in memory
+BATCH_SIZE = 64
+
+log = logging.getLogger("build_search_index")
+
+
+def extract_instance(instance_dir: pathlib.Path) -> tuple[str, str, list[tuple]]:
+    return instance_dir.name, instance_signature(instance_dir), extract_instance_rows(instance_dir)
+
+
+def main(data_dir: pathlib.Path, index_path: pathlib.Path, rebuild: bool):
+    if rebuild:
+        index_path.unlink(missing_ok=True)
+    index = SearchIndex(index_path)
+    indexed = index.signatures()
+
+    dirs = get_combat_dirs(data_dir)
+    current_ids = {d.name for d in dirs}
+    removed = set(indexed) - current_ids
+    if removed:
+        log.info(f"Removing {len(removed)} instances that no longer exist")
+        index.remove_instances(removed)
+
+    stale = [d for d in dirs if indexed.get(d.name) != instance_signature(d)]
+    log.info(f"{len(dirs) - len(stale)} instances are up to date, indexing {len(stale)}")
+    n_rows = 0
+    with tqdm.contrib.logging.logging_redirect_tqdm(), tqdm.tqdm(total=len(stale)) as pbar:
+        for start in range(0, len(stale), BATCH_SIZE):
+            batch = stale[start : start + BATCH_SIZE]
+            if RUN_PARALLEL:
+                results = tqdm.contrib.concurrent.process_map(extract_instance, batch, chunksize=4, leave=False)
+            else:
+                results = map(extract_instance, batch)
+            for instance_id, signature, rows in results:
+                index.index_instance(instance_id, signature, rows)
+                n_rows += len(rows)
+                pbar.update()
+
+    if stale:
+        log.info(f"Indexed {n_rows} messages and commands, optimizing...")
+        index.optimize()
+    index.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Builds the explorer's full-text search index.")
+    parser.add_argument(
+        "-d",
+        "--data-dir",
+        help="the directory containing the raw data (default: data/)",
+        default="data/",
+        type=pathlib.Path,
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help=f"the path to the index (default: {SEARCH_INDEX_PATH})",
+        default=SEARCH_INDEX_PATH,
+        type=pathlib.Path,
+    )
+    parser.add_argument("--rebuild", help="discard the existing index and index everything", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+    main(args.data_dir, args.output, args.rebuild)
@@ -0,0 +1,86 @@
+"""
+Local cache of completions, shared by all of the prediction scripts (through prediction_engine.py).
+
+Completions are stored in a SQLite DB keyed by a hash of the model, prompt, and every completion parameter (temperature,
+max_tokens, stop, ...), so re-running a prediction script (even with --restart) only pays for prompts or parameters it
+has not seen before. Completions from another endpoint (--api-base, e.g. a local stub server) are keyed by its URL too,
+so they are never served to a run against the OpenAI API.
+
+Usage: python completion_cache.py [--clear MODEL]  (prints the number of cached completions per model)
+"""
+import argparse
+import hashlib
+import json
+import pathlib
+import sqlite3
+import time
+
+from dataset.utils import AnyPath
+
+COMPLETION_CACHE_PATH = pathlib.Path("extract/completion_cache.sqlite3")
+
+
+def completion_key(prompt: str, params: dict, api_base: str | None = None) -> bytes:
+    """
+    Returns the cache key for a completion of *prompt* with the given completion parameters (including model) from the
+    API at *api_base* (None for the OpenAI API).
+    """
+    key = {"prompt": prompt, **params}
+    # keys of completions from the OpenAI API stay the same as before endpoints were part of the key
+    if api_base is not None:
+        key["api_base"] = api_base
+    payload = json.dumps(key, sort_keys=True)
+    return hashlib.blake2b(payload.encode(), digest_size=16).digest()
+
+
+class CompletionCache:
+    """Maps completion keys to completion texts in a SQLite DB, keeping hit/miss stats for the run summary."""
+
+    def __init__(self, cache_path: AnyPath = COMPLETION_CACHE_PATH):
+        pathlib.Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(cache_path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS completions (key BLOB PRIMARY KEY, model TEXT, completion TEXT, created REAL)"
+        )
+        self.hits = 0
+        self.misses = 0
+
+    def prefetch(self, keys: list[bytes]) -> dict[bytes, str]:
+        """Returns the cached completion for each of *keys* that is in the cache, in as few queries as possible."""
+        found = {}
+        keys = list(set(keys))
+        # stay under SQLite's bound parameter limit
+        for start in range(0, len(keys), 500):
+            chunk = keys[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.db.execute(f"SELECT key, completion FROM completions WHERE key IN ({placeholders})", chunk)
+            found.update(rows)
+        return found
+
+    def put(self, key: bytes, model: str, completion: str):
+        self.db.execute("INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?)", (key, model, completion, time.time()))
+        self.db.commit()
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def close(self):
+        self.db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shows (or clears) the contents of the completion cache.")
+    parser.add_argument("--cache", help="the cache DB", default=COMPLETION_CACHE_PATH, type=pathlib.Path)
+    parser.add_argument("--clear", help="remove all cached completions from this model", metavar="MODEL")
+    args = parser.parse_args()
+
+    cache = CompletionCache(args.cache)
+    if args.clear:
+        n = cache.db.execute("DELETE FROM completions WHERE model = ?", (args.clear,)).rowcount
+        cache.db.commit()
+        print(f"Removed {n} completions from {args.clear}")
+    for model, n in cache.db.execute("SELECT model, COUNT(*) FROM completions GROUP BY model ORDER BY model"):
+        print(f"{model}: {n}")
+    cache.close()
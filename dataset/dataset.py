@@ -1,15 +1,31 @@
-import csv
-import functools
+import concurrent.futures
 import logging
 import pathlib
+import threading
+import time
+from typing import Callable
 
+import numpy as np
 import pandas as pd
 
 import heuristics
 from dataset import utils
+from dataset.result_store import ResultStore, schema_provenance, table_to_dataframe
 
 log = logging.getLogger(__name__)
 
+# the pseudo-heuristic to sort by instance ID
+ID_SORT_KEY = "_id"
+# heuristic scores are stored as float32 (see instance_heuristics_df)
+SCORE_DTYPE = np.float32
+
+
+def scores_to_float64(values: np.ndarray) -> np.ndarray:
+    """
+    Converts float32 scores to the float64s they print as (e.g. 0.1, not 0.10000000149011612), for serialization.
+    """
+    return values.astype(str).astype(np.float64)
+
 
 class Dataset:
     def __init__(self, data_dir_path: pathlib.Path, result_dir_path: pathlib.Path):
@@ -18,39 +34,97 @@ class Dataset:
         self.dataset_checksum = None
         self.instance_ids = []
         self.heuristic_ids = []
-        self.heuristics_by_instance = {}
-
-    def init(self):
-        log.info("Computing dataset checksum...")
-        self.dataset_checksum = utils.dataset_checksum(self.data_dir_path)
-        self.instance_ids = [instance_path.stem for instance_path in utils.get_combat_dirs(self.data_dir_path)]
-
-        # load the computed heuristic results into memory, validating the checksum
-        log.info("Loading heuristic results...")
-        num_heuristics_attempted_loaded = 0
-        self.heuristics_by_instance = {instance_id: {} for instance_id in self.instance_ids}
-        for heuristic_result in self.result_dir_path.glob("*.csv"):
-            num_heuristics_attempted_loaded += 1
-            heuristic_name = heuristic_result.stem
-            if heuristic_name not in heuristics.__all__:
+        self.instance_heuristics_df = pd.DataFrame(dtype=SCORE_DTYPE)
+        # init progress, for the explorer's /status
+        self.init_phase = "pending"
+        self.init_started_at = None
+        self.init_error = None
+        self.num_heuristic_results = 0
+        # whether the loaded heuristics have been checked against the dataset checksum (until then, some of them may
+        # have been computed over a different version of the dataset)
+        self.heuristics_validated = False
+        # heuristics are published while other threads read them, see _set_heuristics
+        self._lock = threading.RLock()
+        # views derived from instance_heuristics_df, see _derived
+        self._derived_views = {}
+
+    def status(self) -> dict:
+        return {
+            "phase": self.init_phase,
+            "ready": self.init_phase == "ready",
+            "elapsed": time.time() - self.init_started_at if self.init_started_at is not None else 0,
+            "error": self.init_error,
+            "checksum": self.dataset_checksum,
+            "instances": len(self.instance_ids),
+            "heuristics_loaded": len(self.heuristic_ids),
+            "heuristic_results": self.num_heuristic_results,
+            "heuristics_validated": self.heuristics_validated,
+        }
+
+    def init(self, on_update: Callable[[], None] = None):
+        """
+        Lists the instances and loads the computed heuristic results. The heuristics are available as soon as the result
+        store is loaded, but are provisional (heuristics_validated is False) until the dataset checksum, which is
+        computed at the same time, is known and the results computed over a different dataset are dropped. *on_update*
+        is called whenever the available heuristics change.
+        """
+        self.init_started_at = time.time()
+        try:
+            self._init(on_update or (lambda: None))
+        except Exception as e:
+            self.init_phase = "error"
+            self.init_error = repr(e)
+            raise
+
+    def _init(self, on_update: Callable[[], None]):
+        self.init_phase = "listing instances"
+        instance_ids = [instance_path.stem for instance_path in utils.get_combat_dirs(self.data_dir_path)]
+        self._set_heuristics(pd.DataFrame(index=pd.Index(instance_ids, dtype=object), dtype=SCORE_DTYPE))
+        self.instance_ids = instance_ids
+        on_update()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            log.info("Computing dataset checksum...")
+            checksum_future = executor.submit(utils.dataset_checksum, self.data_dir_path)
+
+            # load the computed heuristic results (memory-mapped, so this is quick even for big datasets)
+            self.init_phase = "loading heuristics"
+            log.info("Loading heuristic results...")
+            store = ResultStore(self.result_dir_path)
+            if not store.exists() and any(self.result_dir_path.glob("*.csv")):
+                log.warning(
+                    "Found heuristic results in the old format (one CSV per heuristic); import them with"
+                    " `python heuristic_worker.py --import-csv`."
+                )
+            table = store.read_table()
+            provenance = schema_provenance(table.schema)
+            self.num_heuristic_results = len(provenance)
+            unknown = [heuristic_name for heuristic_name in provenance if heuristic_name not in heuristics.__all__]
+            for heuristic_name in unknown:
                 log.warning(
                     f"Heuristic {heuristic_name!r} has a result but is not defined in heuristics.__all__, skipping..."
                 )
-                continue
-            log.debug(f"loading {heuristic_name=}")
-            with open(heuristic_result, newline="") as f:
-                reader = csv.reader(f)
-                _, checksum = next(reader)
-                if checksum != self.dataset_checksum:
-                    log.warning(f"Heuristic {heuristic_name!r} has an invalid checksum, skipping...")
-                    continue
-                # consume the rest of the iterator of (instance id, score) pairs and construct a mapping
-                for instance_id, score in reader:
-                    self.heuristics_by_instance[instance_id][heuristic_name] = float(score)
-            self.heuristic_ids.append(heuristic_name)
-            log.debug(f"finished {heuristic_name=}")
+            self._set_heuristics(self._align_to_instances(table_to_dataframe(table.drop(unknown))))
+            on_update()
+
+            self.init_phase = "computing checksum"
+            self.dataset_checksum = checksum_future.result()
+
+        # validate the checksums of the loaded results
+        invalid = [
+            heuristic_name
+            for heuristic_name in self.heuristic_ids
+            if provenance[heuristic_name].get("dataset_checksum") != self.dataset_checksum
+        ]
+        for heuristic_name in invalid:
+            log.warning(f"Heuristic {heuristic_name!r} has an invalid checksum, skipping...")
+        if invalid:
+            self._set_heuristics(self.instance_heuristics_df.drop(columns=invalid))
+        self.heuristics_validated = True
+        on_update()
 
         # log warnings if user needs to recompute heuristics
+        num_heuristics_attempted_loaded = self.num_heuristic_results
         if len(self.heuristic_ids) < num_heuristics_attempted_loaded:
             log.warning(
                 f"{num_heuristics_attempted_loaded} heuristics found in results but only"
@@ -63,9 +137,148 @@ class Dataset:
                 " them by running `python heuristic_worker.py`."
             )
 
+        self.init_phase = "ready"
         log.info(f"State init complete ({len(self.heuristic_ids)} heuristics over {len(self.instance_ids)} instances)!")
 
-    @functools.cached_property
-    def instance_heuristics_df(self) -> pd.DataFrame:
-        """Returns the mapping of instance IDs to heuristic values as a DataFrame."""
-        return pd.DataFrame.from_dict(self.heuristics_by_instance, orient="index", columns=self.heuristic_ids)
+    def _align_to_instances(self, df: pd.DataFrame) -> pd.DataFrame:
+        """Returns the results with one row per instance, in instance_ids order (missing instances have no scores)."""
+        index = self.instance_heuristics_df.index
+        if len(df) == len(index) and (df.index.to_numpy(dtype=object) == index.to_numpy(dtype=object)).all():
+            # the heuristic worker writes results in dataset order, so usually there is nothing to line up (or copy)
+            df.index = index
+            return df
+        return df.reindex(index)
+
+    def _set_heuristics(self, instance_heuristics_df: pd.DataFrame):
+        """
+        Replaces the heuristics table (never mutating the old one, which may still be in use) and clears the views
+        derived from it.
+        """
+        with self._lock:
+            self.instance_heuristics_df = instance_heuristics_df
+            self.heuristic_ids = list(instance_heuristics_df.columns)
+            self._derived_views = {}
+
+    def _derived(self, name: str, compute: Callable[[pd.DataFrame], object], df: pd.DataFrame = None):
+        """
+        Returns a view derived from instance_heuristics_df (or from *df*, a snapshot of it), computing it on first use.
+        The view is computed outside the lock (it can take a while), and only kept if the heuristics were not replaced
+        in the meantime.
+        """
+        with self._lock:
+            if df is None:
+                df = self.instance_heuristics_df
+            if df is self.instance_heuristics_df and name in self._derived_views:
+                return self._derived_views[name]
+        view = compute(df)
+        with self._lock:
+            if self.instance_heuristics_df is df:
+                self._derived_views[name] = view
+        return view
+
+    # instance_heuristics_df is the source of truth: a float32 DataFrame with one row per instance (in instance_ids
+    # order) and one column per heuristic, NaN where an instance has no score
+    @property
+    def heuristics_by_instance(self) -> dict[str, dict[str, float]]:
+        """Returns the mapping of instance IDs to heuristic IDs to scores (derived from the DataFrame on first use)."""
+        return self._derived("heuristics_by_instance", self._compute_heuristics_by_instance)
+
+    @staticmethod
+    def _compute_heuristics_by_instance(df: pd.DataFrame) -> dict[str, dict[str, float]]:
+        values = scores_to_float64(df.to_numpy(dtype=SCORE_DTYPE))
+        return {
+            instance_id: {heuristic_id: v for heuristic_id, v in zip(df.columns, row) if v == v}
+            for instance_id, row in zip(df.index, values.tolist())
+        }
+
+    def get_instance_heuristics(self, instance_id: str) -> dict[str, float] | None:
+        """Returns the heuristic scores of one instance, or None if it is not in the dataset."""
+        df = self.instance_heuristics_df
+        try:
+            row = df.loc[instance_id].to_numpy(dtype=SCORE_DTYPE)
+        except KeyError:
+            return None
+        return {heuristic_id: v for heuristic_id, v in zip(df.columns, scores_to_float64(row).tolist()) if v == v}
+
+    @property
+    def sort_permutations(self) -> dict[tuple[str, bool], np.ndarray]:
+        """
+        Returns a map of (sort key, descending) -> row order of instance_heuristics_df, with ties broken by instance ID
+        and missing values last.
+        """
+        return self._derived("sort_permutations", self._compute_sort_permutations)
+
+    @staticmethod
+    def _compute_sort_permutations(df: pd.DataFrame) -> dict[tuple[str, bool], np.ndarray]:
+        id_order = np.argsort(df.index.to_numpy(dtype=str), kind="stable")
+        permutations = {(ID_SORT_KEY, False): id_order, (ID_SORT_KEY, True): id_order[::-1].copy()}
+        for heuristic_id in df.columns:
+            values = df[heuristic_id].to_numpy(dtype=np.float64)[id_order]
+            # stable sorts of the ID-ordered values keep ties in ID order; NaN sorts last either way
+            permutations[(heuristic_id, False)] = id_order[np.argsort(values, kind="stable")]
+            permutations[(heuristic_id, True)] = id_order[np.argsort(-values, kind="stable")]
+        return permutations
+
+    def query_heuristics(
+        self,
+        sort: list[tuple[str, bool]] = (),
+        ranges: dict[str, tuple[float | None, float | None]] = None,
+        prefix: str = "",
+        page: int = 0,
+        limit: int = 250,
+    ) -> tuple[int, list[tuple[str, dict[str, float | None]]]]:
+        """
+        Returns the number of instances matching the filters and one page of (instance id, heuristic scores) pairs.
+
+        :param sort: A list of (sort key, descending) pairs in priority order. Sort keys are heuristic IDs or "_id".
+        :param ranges: A map of heuristic ID -> (min, max) inclusive bounds (either bound may be None).
+        :param prefix: Only include instances whose ID starts with this.
+        """
+        # take a consistent snapshot, in case the heuristics are replaced while we work
+        with self._lock:
+            df = self.instance_heuristics_df
+            heuristic_ids = self.heuristic_ids
+        sort_permutations = self._derived("sort_permutations", self._compute_sort_permutations, df)
+        sort = [(key, desc) for key, desc in sort if key == ID_SORT_KEY or key in heuristic_ids]
+        if not sort:
+            sort = [(ID_SORT_KEY, False)]
+
+        # single keys use the precomputed orders; multiple keys are sorted on demand
+        if len(sort) == 1:
+            order = sort_permutations[sort[0]]
+        else:
+            id_rank = np.empty(len(df), dtype=np.int64)
+            id_rank[sort_permutations[(ID_SORT_KEY, False)]] = np.arange(len(df))
+            keys = [id_rank]
+            for key, desc in reversed(sort):
+                if key == ID_SORT_KEY:
+                    keys.append(-id_rank if desc else id_rank)
+                else:
+                    values = df[key].to_numpy(dtype=np.float64)
+                    keys.append(-values if desc else values)
+            order = np.lexsort(keys)
+
+        # filter
+        mask = None
+        for heuristic_id, (lo, hi) in (ranges or {}).items():
+            if heuristic_id not in heuristic_ids:
+                continue
+            values = df[heuristic_id].to_numpy(dtype=np.float64)
+            if lo is not None:
+                mask = (values >= lo) if mask is None else (mask & (values >= lo))
+            if hi is not None:
+                mask = (values <= hi) if mask is None else (mask & (values <= hi))
+        if prefix:
+            prefix_mask = df.index.str.startswith(prefix)
+            mask = prefix_mask if mask is None else (mask & prefix_mask)
+        if mask is not None:
+            order = order[mask[order]]
+
+        # paginate
+        page_rows = df.iloc[order[page * limit : (page + 1) * limit]]
+        page_values = scores_to_float64(page_rows.to_numpy(dtype=SCORE_DTYPE)).tolist()
+        instances = [
+            (instance_id, {k: (None if np.isnan(v) else v) for k, v in zip(heuristic_ids, row)})
+            for instance_id, row in zip(page_rows.index, page_values)
+        ]
+        return len(order), instances
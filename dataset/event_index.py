@@ -0,0 +1,164 @@
+"""
+Line-offset indexes over instances' events, so that a range of events (optionally of one type) can be read without
+decompressing or decoding any of the events before it.
+
+The first time an instance is indexed, its events are decompressed once into an uncompressed payload (see
+payload_cache.py) and the byte offset and type of every event are saved in ``{cache_dir}/{instance_id}.idx.npz``. Both
+are rebuilt if the instance's files change.
+"""
+import json
+import logging
+import os
+import pathlib
+from typing import Iterable, NamedTuple
+
+import numpy as np
+
+from . import utils
+from .payload_cache import Buffer, KeyedLocks, PayloadCache, files_signature
+
+log = logging.getLogger(__name__)
+
+READ_CHUNK_SIZE = 1 << 20
+
+
+class EventIndex(NamedTuple):
+    signature: str
+    offsets: np.ndarray  # event i is bytes [offsets[i], offsets[i + 1]) of the uncompressed copy
+    type_codes: np.ndarray  # event i has type event_types[type_codes[i]]
+    event_types: list[str]
+
+    def __len__(self):
+        return len(self.type_codes)
+
+    def event_type_counts(self) -> dict[str, int]:
+        counts = np.bincount(self.type_codes, minlength=len(self.event_types))
+        return {event_type: int(n) for event_type, n in zip(self.event_types, counts)}
+
+    def select(self, event_type: str | None = None) -> np.ndarray:
+        """Returns the indices of all events (of the given type, if any)."""
+        if event_type is None:
+            return np.arange(len(self))
+        if event_type not in self.event_types:
+            return np.arange(0)
+        return np.flatnonzero(self.type_codes == self.event_types.index(event_type))
+
+
+class EventIndexCache:
+    def __init__(self, data_dir_path: pathlib.Path, cache_dir_path: pathlib.Path, payloads: PayloadCache):
+        self.data_dir_path = data_dir_path
+        self.cache_dir_path = cache_dir_path
+        self.payloads = payloads
+        self._indexes: dict[str, EventIndex] = {}
+        self._build_locks = KeyedLocks()
+
+    # ==== paths ====
+    def index_path(self, instance_id: str) -> pathlib.Path:
+        return self.cache_dir_path / f"{instance_id}.idx.npz"
+
+    def source_signature(self, instance_id: str) -> str:
+        """Returns a cheap fingerprint (names, sizes, and mtimes) of an instance's event files."""
+        return files_signature(self.data_dir_path.joinpath(instance_id).glob("*.gz"))
+
+    # ==== payload ====
+    def _events_payload_chunks(self, instance_id: str) -> Iterable[bytes]:
+        for event_bytes in utils.combat_dir_iterator_raw(self.data_dir_path / instance_id):
+            if event_bytes.strip():
+                yield event_bytes
+
+    def get_payload(self, instance_id: str) -> Buffer:
+        """Returns all of the instance's events as uncompressed JSONL (from the payload cache)."""
+        return self.payloads.get(
+            f"events-{instance_id}",
+            self.source_signature(instance_id),
+            lambda: self._events_payload_chunks(instance_id),
+        )
+
+    def is_payload_cached(self, instance_id: str) -> bool:
+        """Returns whether get_payload would return the instance's events without decompressing them first."""
+        return self.payloads.is_cached(f"events-{instance_id}", self.source_signature(instance_id))
+
+    # ==== index ====
+    def get_index(self, instance_id: str) -> EventIndex:
+        """Returns the up-to-date index of an instance's events, loading it from disk or building it if necessary."""
+        signature = self.source_signature(instance_id)
+        index = self._indexes.get(instance_id)
+        if index is not None and index.signature == signature:
+            return index
+
+        with self._build_locks.hold(instance_id):
+            index = self._load_index(instance_id)
+            if index is None or index.signature != signature:
+                index = self._build_index(instance_id, signature)
+            self._indexes[instance_id] = index
+            return index
+
+    def _load_index(self, instance_id: str) -> EventIndex | None:
+        index_path = self.index_path(instance_id)
+        if not index_path.exists():
+            return None
+        with np.load(index_path) as data:
+            return EventIndex(
+                signature=str(data["signature"]),
+                offsets=data["offsets"],
+                type_codes=data["type_codes"],
+                event_types=data["event_types"].tolist(),
+            )
+
+    def _build_index(self, instance_id: str, signature: str) -> EventIndex:
+        log.info(f"Indexing events of {instance_id}...")
+        self.cache_dir_path.mkdir(parents=True, exist_ok=True)
+        payload = self.get_payload(instance_id)
+
+        # every event ends with a newline
+        newlines = np.flatnonzero(np.frombuffer(payload, dtype=np.uint8) == ord("\n"))
+        offsets = np.concatenate(([0], newlines + 1)).astype(np.int64)
+        type_codes = np.empty(len(newlines), dtype=np.uint16)
+        event_types = {}
+        for idx, (start, end) in enumerate(zip(offsets[:-1].tolist(), offsets[1:].tolist())):
+            event_type = json.loads(payload[start:end])["event_type"]
+            type_codes[idx] = event_types.setdefault(event_type, len(event_types))
+
+        index = EventIndex(signature=signature, offsets=offsets, type_codes=type_codes, event_types=list(event_types))
+        tmp_index_path = self.cache_dir_path / f"{instance_id}.idx.tmp.npz"
+        np.savez(
+            tmp_index_path,
+            signature=np.array(signature),
+            offsets=index.offsets,
+            type_codes=index.type_codes,
+            event_types=np.array(index.event_types, dtype=str),
+        )
+        os.replace(tmp_index_path, self.index_path(instance_id))
+        log.info(f"Indexed {len(index)} events of {instance_id} ({offsets[-1]} bytes)")
+        return index
+
+    # ==== reading ====
+    def select(
+        self, instance_id: str, offset: int = 0, limit: int | None = None, event_type: str | None = None
+    ) -> tuple[int, np.ndarray]:
+        """
+        Returns the number of events (of the given type, if any) in an instance and the indices of the events in the
+        requested range of them.
+        """
+        selected = self.get_index(instance_id).select(event_type)
+        end = None if limit is None else offset + limit
+        return len(selected), selected[offset:end]
+
+    def read_events(self, instance_id: str, event_idxs: np.ndarray) -> Iterable[bytes]:
+        """Yields the raw JSON lines of the given events (in the order given) from the uncompressed payload."""
+        if not len(event_idxs):
+            return
+        offsets = self.get_index(instance_id).offsets
+        payload = self.get_payload(instance_id)
+        # slice each run of consecutive events at once
+        run_breaks = np.flatnonzero(np.diff(event_idxs) != 1) + 1
+        for run in np.split(event_idxs, run_breaks):
+            start, end = int(offsets[run[0]]), int(offsets[run[-1] + 1])
+            yield from iter_chunks(payload, start, end)
+
+
+def iter_chunks(payload: Buffer, start: int = 0, end: int | None = None) -> Iterable[bytes]:
+    """Yields bytes [start, end) of a payload in chunks of at most READ_CHUNK_SIZE."""
+    end = len(payload) if end is None else end
+    for chunk_start in range(start, end, READ_CHUNK_SIZE):
+        yield payload[chunk_start : min(chunk_start + READ_CHUNK_SIZE, end)]
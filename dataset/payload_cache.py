@@ -0,0 +1,223 @@
+"""
+Two-tier cache of decompressed payloads (e.g. an instance's events as uncompressed JSONL).
+
+A payload is decompressed once and written to an uncompressed file on disk, which is read with mmap from then on. The
+most recently used payloads are also kept in memory, up to a total size in bytes. The files on disk are bounded by
+another total size: whenever a payload is written, the least recently used files are deleted (their access times are
+updated on every disk hit). Each payload has a signature (e.g. a fingerprint of its source files) and is rebuilt if the
+signature changes.
+"""
+import collections
+import contextlib
+import hashlib
+import json
+import logging
+import mmap
+import os
+import pathlib
+import threading
+from typing import Callable, Iterable
+
+log = logging.getLogger(__name__)
+
+Buffer = bytes | mmap.mmap
+
+
+def files_signature(paths: Iterable[pathlib.Path]) -> str:
+    """Returns a cheap fingerprint (names, sizes, and mtimes) of some files."""
+    files = []
+    for path in paths:
+        stat = path.stat()
+        files.append((path.name, stat.st_size, stat.st_mtime_ns))
+    return hashlib.md5(json.dumps(sorted(files)).encode()).hexdigest()
+
+
+class KeyedLocks:
+    """Per-key locks, created on first use and dropped once no thread holds or waits for them (so they never pile up)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks: dict[str, list] = {}  # key -> [lock, number of threads holding or waiting for it]
+
+    @contextlib.contextmanager
+    def hold(self, key: str, blocking: bool = True):
+        """
+        Holds the lock for *key*, yielding True. If *blocking* is False and another thread holds or waits for the lock,
+        yields False without taking it.
+        """
+        with self._lock:
+            entry = self._locks.get(key)
+            if entry is not None and not blocking:
+                entry = None
+            else:
+                if entry is None:
+                    entry = self._locks[key] = [threading.Lock(), 0]
+                entry[1] += 1
+        if entry is None:
+            yield False
+            return
+        try:
+            with entry[0]:
+                yield True
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+class PayloadCache:
+    def __init__(self, cache_dir_path: pathlib.Path, max_memory_bytes: int, max_disk_bytes: int):
+        self.cache_dir_path = cache_dir_path
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._memory: collections.OrderedDict[str, tuple[str, bytes]] = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._build_locks = KeyedLocks()
+        # stats
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self._disk_bytes = sum(size for _, _, size in self._disk_entries())
+
+    # ==== paths ====
+    def payload_path(self, key: str) -> pathlib.Path:
+        return self.cache_dir_path / f"{key}.payload"
+
+    def signature_path(self, key: str) -> pathlib.Path:
+        return self.cache_dir_path / f"{key}.payload.sig"
+
+    def is_cached(self, key: str, signature: str) -> bool:
+        """Returns whether the payload is cached (in memory or on disk) with the given signature."""
+        with self._lock:
+            if key in self._memory and self._memory[key][0] == signature:
+                return True
+        return self._disk_signature(key) == signature
+
+    def _disk_signature(self, key: str) -> str | None:
+        try:
+            return self.signature_path(key).read_text()
+        except FileNotFoundError:
+            return None
+
+    # ==== get ====
+    def get(self, key: str, signature: str, produce: Callable[[], Iterable[bytes]]) -> Buffer:
+        """
+        Returns the payload for *key*. If it is not cached with the given signature, it is built by writing each chunk
+        yielded by *produce* to disk.
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and entry[0] == signature:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+
+        with self._build_locks.hold(key):
+            if self._disk_signature(key) == signature:
+                with self._lock:
+                    self.disk_hits += 1
+                # mark the file as recently used, for disk eviction
+                os.utime(self.payload_path(key))
+            else:
+                with self._lock:
+                    self.misses += 1
+                self._write_payload(key, signature, produce())
+                self._evict_disk(keep=key)
+            payload = self._read_payload(key)
+
+        if len(payload) <= self.max_memory_bytes:
+            payload = bytes(payload)
+            self._remember(key, signature, payload)
+        return payload
+
+    def _write_payload(self, key: str, signature: str, chunks: Iterable[bytes]):
+        self.cache_dir_path.mkdir(parents=True, exist_ok=True)
+        path = self.payload_path(key)
+        tmp_path = path.with_suffix(".tmp")
+        n_bytes = 0
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                n_bytes += len(chunk)
+        # the signature is written last, so a partially written payload is never used
+        self.signature_path(key).unlink(missing_ok=True)
+        os.replace(tmp_path, path)
+        self.signature_path(key).write_text(signature)
+        log.info(f"Cached {key} ({n_bytes} bytes)")
+
+    def _read_payload(self, key: str) -> Buffer:
+        with open(self.payload_path(key), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            # the mapping stays valid after the file is closed
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _disk_entries(self) -> list[tuple[str, float, int]]:
+        """Returns the (key, access time, size) of each payload on disk."""
+        entries = []
+        for path in self.cache_dir_path.glob("*.payload"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((path.stem, stat.st_atime, stat.st_size))
+        return entries
+
+    def _evict_disk(self, keep: str):
+        """Deletes the least recently used payloads on disk (except *keep*) until they fit in max_disk_bytes."""
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[1])
+        disk_bytes = sum(size for _, _, size in entries)
+        for key, _, size in entries:
+            if disk_bytes <= self.max_disk_bytes:
+                break
+            if key == keep:
+                continue
+            # skip payloads that are being built or read right now (waiting for them could deadlock)
+            with self._build_locks.hold(key, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                # the signature goes first, so a payload without one is never used; open mmaps of it stay valid
+                self.signature_path(key).unlink(missing_ok=True)
+                self.payload_path(key).unlink(missing_ok=True)
+            disk_bytes -= size
+            with self._lock:
+                self.disk_evictions += 1
+            log.info(f"Evicted {key} from disk ({size} bytes)")
+        if disk_bytes > self.max_disk_bytes:
+            log.warning(f"Payload cache uses {disk_bytes} bytes on disk, over its budget of {self.max_disk_bytes}")
+        with self._lock:
+            self._disk_bytes = disk_bytes
+
+    def _remember(self, key: str, signature: str, payload: bytes):
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes -= len(old[1])
+            self._memory[key] = (signature, payload)
+            self._memory_bytes += len(payload)
+            # evict least recently used payloads (they stay on disk)
+            while self._memory_bytes > self.max_memory_bytes:
+                _, (_, evicted) = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "max_memory_bytes": self.max_memory_bytes,
+                "disk_evictions": self.disk_evictions,
+                "disk_bytes": self._disk_bytes,
+                "max_disk_bytes": self.max_disk_bytes,
+            }
@@ -0,0 +1,244 @@
+"""
+Columnar store of computed heuristic results: one Arrow IPC file (``heuristic_results/heuristics.arrow``) with an
+``instance_id`` column and one float32 column per heuristic.
+
+Each heuristic column carries its provenance in its field metadata:
+
+- ``code_hash``: hash of the source of the module defining the heuristic, see :func:`heuristic_code_hash`
+- ``dataset_checksum``: checksum of the dataset it was computed over
+- ``computed_at``: UNIX timestamp of when it was computed
+
+The file is written uncompressed, so readers memory-map it and get each column without copying or decoding it.
+Columns are upserted by rewriting the file to a temporary path and atomically replacing it, so a reader never sees a
+partial file. Writers hold an exclusive lock (``heuristics.arrow.lock``) from reading the store to replacing it, so
+concurrent heuristic workers never lose each other's columns.
+"""
+import contextlib
+import csv
+import fcntl
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from .utils import AnyPath
+
+log = logging.getLogger(__name__)
+
+RESULT_STORE_FILENAME = "heuristics.arrow"
+LOCK_FILENAME = "heuristics.arrow.lock"
+ID_COLUMN = "instance_id"
+SCORE_TYPE = pa.float32()
+
+
+def heuristic_code_hash(heuristic) -> str:
+    """
+    Returns a hash of the source of the module defining a heuristic (so changes to the helpers it calls in the same
+    module also count as changes to the heuristic).
+    """
+    source = inspect.getsource(inspect.getmodule(heuristic))
+    return hashlib.sha256(source.encode()).hexdigest()[:16]
+
+
+def schema_provenance(schema: pa.Schema) -> dict[str, dict]:
+    """Returns the provenance of each heuristic in a store's schema (heuristic id -> code_hash, dataset_checksum, ...)."""
+    return {
+        field.name: json.loads((field.metadata or {}).get(b"provenance", b"{}"))
+        for field in schema
+        if field.name != ID_COLUMN
+    }
+
+
+def table_to_dataframe(table: pa.Table) -> pd.DataFrame:
+    """
+    Returns a store's table as a DataFrame indexed by instance ID with one float32 column per heuristic. The columns are
+    read-only views of the table's buffers (so of the memory-mapped file, for a table from ResultStore.read_table).
+    """
+    instance_ids = table.column(ID_COLUMN).to_numpy(zero_copy_only=False)
+    df = table.drop([ID_COLUMN]).to_pandas(split_blocks=True, self_destruct=True)
+    df.index = pd.Index(instance_ids, dtype=object, name=ID_COLUMN)
+    return df
+
+
+class ResultStore:
+    def __init__(self, result_dir_path: AnyPath):
+        self.path = pathlib.Path(result_dir_path) / RESULT_STORE_FILENAME
+        self.lock_path = pathlib.Path(result_dir_path) / LOCK_FILENAME
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    # ==== reading ====
+    def read_table(self) -> pa.Table:
+        """Returns the whole store as a memory-mapped Arrow table (or an empty table if there is no store yet)."""
+        if not self.path.exists():
+            return pa.table({ID_COLUMN: pa.array([], pa.string())})
+        with pa.memory_map(str(self.path)) as source:
+            return pa.ipc.open_file(source).read_all()
+
+    def provenance(self) -> dict[str, dict]:
+        """Returns the provenance of each heuristic in the store, without reading any results."""
+        if not self.path.exists():
+            return {}
+        with pa.memory_map(str(self.path)) as source:
+            return schema_provenance(pa.ipc.open_file(source).schema)
+
+    def read_dataframe(self) -> pd.DataFrame:
+        """Returns the store as a DataFrame (see table_to_dataframe)."""
+        return table_to_dataframe(self.read_table())
+
+    # ==== writing ====
+    def upsert_column(
+        self,
+        heuristic_id: str,
+        instance_ids: list[str],
+        scores: np.ndarray,
+        code_hash: str,
+        dataset_checksum: str,
+        computed_at: float = None,
+    ):
+        """
+        Adds or replaces a heuristic's column. The store's rows become *instance_ids*; the other heuristics' scores are
+        kept for the instances they were computed for (their provenance still says which dataset that was), and dropped
+        (with a warning) for instances that are not in *instance_ids*.
+        """
+        with self._locked():
+            self._upsert_column(heuristic_id, instance_ids, scores, code_hash, dataset_checksum, computed_at)
+
+    def _upsert_column(self, heuristic_id, instance_ids, scores, code_hash, dataset_checksum, computed_at):
+        table = self.read_table()
+        old_ids = table.column(ID_COLUMN).to_numpy(zero_copy_only=False)
+        same_rows = len(old_ids) == len(instance_ids) and bool(
+            (old_ids == np.asarray(instance_ids, dtype=object)).all()
+        )
+        if not same_rows:
+            positions = pd.Index(old_ids, dtype=object).get_indexer(instance_ids)
+            found = positions >= 0
+            self._warn_dropped_rows(table, old_ids, instance_ids, heuristic_id)
+
+        provenance = {
+            "code_hash": code_hash,
+            "dataset_checksum": dataset_checksum,
+            "computed_at": computed_at if computed_at is not None else time.time(),
+        }
+        new_field = pa.field(heuristic_id, SCORE_TYPE, metadata={"provenance": json.dumps(provenance)})
+        new_column = pa.array(np.asarray(scores, dtype=np.float32), SCORE_TYPE)
+
+        fields = [pa.field(ID_COLUMN, pa.string())]
+        columns = [pa.array(instance_ids, pa.string())]
+        for field, column in zip(table.schema, table.columns):
+            if field.name == ID_COLUMN:
+                continue
+            # a recomputed heuristic keeps its place
+            if field.name == heuristic_id:
+                field, values = new_field, new_column
+            else:
+                values = column.to_numpy()
+                if not same_rows:
+                    realigned = np.full(len(instance_ids), np.nan, dtype=np.float32)
+                    realigned[found] = values[positions[found]]
+                    values = realigned
+                values = pa.array(values, SCORE_TYPE)
+            fields.append(field)
+            columns.append(values)
+        if heuristic_id not in table.schema.names:
+            fields.append(new_field)
+            columns.append(new_column)
+        self._write(pa.Table.from_arrays(columns, schema=pa.schema(fields)))
+
+    @staticmethod
+    def _warn_dropped_rows(table: pa.Table, old_ids: np.ndarray, instance_ids: list[str], heuristic_id: str):
+        """Logs the number of instances leaving the store that still have scores of other heuristics."""
+        dropped = ~pd.Index(old_ids, dtype=object).isin(instance_ids)
+        if not dropped.any():
+            return
+        has_scores = np.zeros(len(old_ids), dtype=bool)
+        for field, column in zip(table.schema, table.columns):
+            if field.name not in (ID_COLUMN, heuristic_id):
+                has_scores |= ~np.isnan(column.to_numpy())
+        n_dropped = int((dropped & has_scores).sum())
+        if n_dropped:
+            log.warning(
+                f"Upserting {heuristic_id!r} drops {n_dropped} instances that have scores of other heuristics"
+                f" (e.g. {old_ids[dropped & has_scores][0]!r})"
+            )
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Holds the store's exclusive write lock (blocking until other writers release it)."""
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _write(self, table: pa.Table):
+        """Atomically replaces the store with *table*. Callers must hold the write lock."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=f"{RESULT_STORE_FILENAME}.", suffix=".tmp")
+        os.close(fd)
+        try:
+            # one record batch, so that each column is one contiguous buffer for readers
+            with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table, max_chunksize=max(table.num_rows, 1))
+            with open(tmp_path, "rb") as f:
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            pathlib.Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+    # ==== migration ====
+    def import_csv_results(
+        self, csv_paths: list[pathlib.Path], code_hashes: dict[str, str], instance_ids: list[str] = ()
+    ):
+        """
+        Imports heuristic results from the old one-CSV-per-heuristic format (a (checksum, <checksum>) header row, then
+        (instance id, score) rows). The code that computed them is unknown, so they are recorded as computed by the
+        given current code hashes.
+
+        The CSVs may cover different instances, so the store's rows become *instance_ids* (e.g. the current dataset, in
+        order) followed by every other instance that is already in the store or has a score in any of the CSVs.
+        """
+        results = []
+        for csv_path in csv_paths:
+            with open(csv_path, newline="") as f:
+                _, checksum = next(csv.reader(f))
+            rows = pd.read_csv(
+                csv_path,
+                skiprows=1,
+                header=None,
+                names=[ID_COLUMN, "score"],
+                dtype={ID_COLUMN: str, "score": np.float32},
+            )
+            results.append((csv_path, checksum, rows))
+
+        all_ids = dict.fromkeys(instance_ids)
+        all_ids.update(dict.fromkeys(self.read_table().column(ID_COLUMN).to_pylist()))
+        for _, _, rows in results:
+            all_ids.update(dict.fromkeys(rows[ID_COLUMN]))
+        all_ids = pd.Index(list(all_ids), dtype=object)
+
+        for csv_path, checksum, rows in results:
+            heuristic_id = csv_path.stem
+            scores = np.full(len(all_ids), np.nan, dtype=np.float32)
+            scores[all_ids.get_indexer(rows[ID_COLUMN])] = rows["score"].to_numpy(dtype=np.float32)
+            self.upsert_column(
+                heuristic_id,
+                all_ids.tolist(),
+                scores,
+                code_hash=code_hashes.get(heuristic_id, ""),
+                dataset_checksum=checksum,
+                computed_at=csv_path.stat().st_mtime,
+            )
+            log.info(f"Imported {heuristic_id} from {csv_path}")
@@ -0,0 +1,170 @@
+"""
+Full-text index over the content, author, and command name of every message and command in the dataset (SQLite FTS5).
+
+Each hit records its instance and the position of the event in the instance (as served by /events/{instance_id}, so
+``?offset={event_idx}`` links straight to it). Instances are indexed independently, and only re-indexed when their files
+change (see build_search_index.py).
+"""
+import json
+import pathlib
+import sqlite3
+from typing import Iterable, NamedTuple
+
+from . import utils
+from .payload_cache import files_signature
+
+INDEXED_EVENT_TYPES = ("message", "command")
+# bm25 weights of the indexed columns (content, author_name, command_name)
+RANK_WEIGHTS = (1.0, 0.5, 0.5)
+
+
+class SearchHit(NamedTuple):
+    instance_id: str
+    event_idx: int
+    event_type: str
+    author_name: str
+    command_name: str | None
+    snippet: str
+    score: float
+
+
+def instance_signature(instance_dir: pathlib.Path) -> str:
+    return files_signature(instance_dir.glob("*.gz"))
+
+
+def extract_instance_rows(instance_dir: pathlib.Path) -> list[tuple]:
+    """
+    Returns one (content, author_name, command_name, event_idx, event_type) row per message/command in an instance.
+    The event indices count every non-blank event, like EventIndexCache.
+    """
+    rows = []
+    event_idx = 0
+    for event_bytes in utils.combat_dir_iterator_raw(instance_dir):
+        if not event_bytes.strip():
+            continue
+        # only messages and commands have content, skip decoding everything else
+        if b'"content"' in event_bytes:
+            event = json.loads(event_bytes)
+            if event["event_type"] in INDEXED_EVENT_TYPES:
+                rows.append(
+                    (
+                        event.get("content") or "",
+                        event.get("author_name") or "",
+                        event.get("command_name"),
+                        event_idx,
+                        event["event_type"],
+                    )
+                )
+        event_idx += 1
+    return rows
+
+
+def to_match_query(text: str) -> str:
+    """Quotes each word of a plain-text query, so that it matches events containing all of them (as FTS5 syntax)."""
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+class SearchIndex:
+    def __init__(self, db_path: pathlib.Path, readonly: bool = False):
+        self.db_path = db_path
+        if readonly:
+            self.db = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            db_path.parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(db_path)
+            self.db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS instances (
+                    instance_id TEXT PRIMARY KEY, signature TEXT, first_rowid INTEGER, n_rows INTEGER
+                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS events USING fts5(
+                    content,
+                    author_name,
+                    command_name,
+                    instance_id UNINDEXED,
+                    event_idx UNINDEXED,
+                    event_type UNINDEXED,
+                    tokenize = 'unicode61 remove_diacritics 2'
+                );
+                """
+            )
+
+    # ==== indexing ====
+    def signatures(self) -> dict[str, str]:
+        """Returns the signature of the files each instance was indexed from."""
+        return dict(self.db.execute("SELECT instance_id, signature FROM instances"))
+
+    def index_instance(self, instance_id: str, signature: str, rows: Iterable[tuple]):
+        """Replaces an instance's entries with the given rows (see extract_instance_rows) in one transaction."""
+        rows = list(rows)
+        with self.db:
+            self._delete_events(instance_id)
+            # each instance's entries get a contiguous range of rowids, so that they can be deleted by rowid (FTS5
+            # cannot look up entries by an UNINDEXED column without scanning every entry)
+            (first_rowid,) = self.db.execute("SELECT COALESCE(MAX(rowid), 0) + 1 FROM events").fetchone()
+            self.db.executemany(
+                "INSERT INTO events (rowid, content, author_name, command_name, event_idx, event_type, instance_id)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                ((first_rowid + i, *row, instance_id) for i, row in enumerate(rows)),
+            )
+            self.db.execute(
+                "INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?)", (instance_id, signature, first_rowid, len(rows))
+            )
+
+    def remove_instances(self, instance_ids: Iterable[str]):
+        with self.db:
+            for instance_id in instance_ids:
+                self._delete_events(instance_id)
+                self.db.execute("DELETE FROM instances WHERE instance_id = ?", (instance_id,))
+
+    def _delete_events(self, instance_id: str):
+        """Deletes an instance's entries (if it was indexed)."""
+        row = self.db.execute(
+            "SELECT first_rowid, n_rows FROM instances WHERE instance_id = ?", (instance_id,)
+        ).fetchone()
+        if row is None or not row[1]:
+            return
+        first_rowid, n_rows = row
+        self.db.execute("DELETE FROM events WHERE rowid BETWEEN ? AND ?", (first_rowid, first_rowid + n_rows - 1))
+
+    def optimize(self):
+        """Merges the index's b-trees, which makes searches faster after a big (re)index."""
+        with self.db:
+            self.db.execute("INSERT INTO events (events) VALUES ('optimize')")
+
+    # ==== searching ====
+    def search(
+        self,
+        match: str,
+        instance_id: str | None = None,
+        event_type: str | None = None,
+        offset: int = 0,
+        limit: int = 50,
+    ) -> tuple[int, list[SearchHit]]:
+        """
+        Returns the total number of events matching the FTS5 query *match* (optionally only in one instance or of one
+        event type) and the requested range of them, best match first.
+        Raises sqlite3.OperationalError if *match* is not a valid FTS5 query.
+        """
+        where = "events MATCH ?"
+        params = [match]
+        if instance_id is not None:
+            where += " AND instance_id = ?"
+            params.append(instance_id)
+        if event_type is not None:
+            where += " AND event_type = ?"
+            params.append(event_type)
+
+        (total,) = self.db.execute(f"SELECT COUNT(*) FROM events WHERE {where}", params).fetchone()
+        weights = ", ".join(map(str, RANK_WEIGHTS))
+        rows = self.db.execute(
+            "SELECT instance_id, event_idx, event_type, author_name, command_name,"
+            f" snippet(events, 0, '<mark>', '</mark>', '...', 24), bm25(events, {weights}) AS score"
+            f" FROM events WHERE {where} ORDER BY score LIMIT ? OFFSET ?",
+            params + [limit, offset],
+        )
+        # bm25 is lower-is-better, flip it so that scores read naturally
+        return total, [SearchHit(*row[:-1], score=-row[-1]) for row in rows]
+
+    def close(self):
+        self.db.close()
@@ -11,29 +11,82 @@ Output: {
 }
 - with `after` filtered to only include IC-classified utterances (maybe `before` too - see how you feel about it)
 """
+import concurrent.futures
 import glob
+import json
 import logging
+import os
 import pathlib
+import random
+import threading
 import time
 
 import openai
 import tqdm.contrib.concurrent
 import tqdm.contrib.logging
 
-from dataset.utils import read_gzipped_file, write_jsonl
+from dataset.utils import read_gzipped_file, read_gzipped_file_raw, write_jsonl
 
 DATA_DIR = pathlib.Path("data/")
 # IN_DIR = pathlib.Path("extract/experiment2/")
 IN_DIR = pathlib.Path("extract/experiment3a/")
 OUT_DIR = pathlib.Path("extract/experiment3b/")
 
+JOURNAL_PATH = OUT_DIR / "_journal.jsonl"
+PARTIAL_DIR = OUT_DIR / ".partial"
+
 CLASSIFIER_FINETUNE = "ada:ft-ccb-lab-members-2022-11-28-18-29-25"
+NUM_WORKERS = 16  # number of files processed concurrently
+REQUESTS_PER_MINUTE = 3000  # shared by all workers
+MAX_RETRIES = 6  # per request, with exponential backoff
+
+RETRYABLE_ERRORS = (
+    openai.error.APIConnectionError,
+    openai.error.APIError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+)
 
 log = logging.getLogger("distill3")
 loglevel = logging.INFO
 logging.getLogger("openai").setLevel(logging.WARNING)
 
 
+class RateLimiter:
+    """Thread-safe limiter that spaces out calls so that at most *per_minute* calls start each minute."""
+
+    def __init__(self, per_minute: int):
+        self.interval = 60 / per_minute
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(self.next_slot, now)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+rate_limiter = RateLimiter(REQUESTS_PER_MINUTE)
+
+
+def create_completion(**kwargs):
+    """Requests a completion, retrying transient API errors (e.g. when the workers hit the rate limit) with backoff."""
+    for attempt in range(MAX_RETRIES + 1):
+        rate_limiter.wait()
+        try:
+            return openai.Completion.create(**kwargs)
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES:
+                raise
+            delay = min(60, 2**attempt) * random.uniform(0.5, 1.5)
+            log.warning(f"{type(e).__name__}: {e} (retrying in {delay:.1f}s)")
+            time.sleep(delay)
+
+
 def get_ooc_ic_label(text, finetuned_model=CLASSIFIER_FINETUNE):
     if not text:
         return "out-of-character", 1
@@ -44,7 +97,7 @@ def get_ooc_ic_label(text, finetuned_model=CLASSIFIER_FINETUNE):
     if len(text.split(" ")) > 200:
         text = " ".join(text.split(" ")[:200])
     for _ in range(3):
-        response = openai.Completion.create(
+        response = create_completion(
             model=finetuned_model,
             prompt=text + "\nlabel: ",
             temperature=0,
@@ -55,7 +108,6 @@ def get_ooc_ic_label(text, finetuned_model=CLASSIFIER_FINETUNE):
             stop=["###", "\n"],
             logprobs=1,
         )
-        time.sleep(0.05)
         label = response["choices"][0]["text"].strip()
         if label == "in-character" or label == "out-of-character" or label == "mixed":
             prob = 2 ** (response["choices"][0]["logprobs"]["token_logprobs"][0])
@@ -102,25 +154,90 @@ def process_file(fp: pathlib.Path):
         return num_triples_in, 0
 
     # see what we get
-    write_jsonl(OUT_DIR / f"{combat_id}.jsonl.gz", out)
+    # write to a scratch dir first so that a crash mid-write never leaves a partial output that looks complete
+    partial_path = PARTIAL_DIR / f"{combat_id}.jsonl.gz"
+    write_jsonl(partial_path, out)
+    os.replace(partial_path, OUT_DIR / f"{combat_id}.jsonl.gz")
     return num_triples_in, len(out)
 
 
+# ===== resumable runner =====
+def load_journal() -> dict[str, tuple[int, int]]:
+    """Returns a mapping of input filename -> (n_triples_in, n_triples_out) for each file completed in a prior run."""
+    completed = {}
+    try:
+        with open(JOURNAL_PATH) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:  # a crash mid-write can truncate the last line
+                    continue
+                completed[entry["file"]] = (entry["n_in"], entry["n_out"])
+    except FileNotFoundError:
+        pass
+    return completed
+
+
+def run_resumable(files: list[pathlib.Path]) -> list[tuple[int, int]]:
+    """
+    Processes the given files concurrently (sharing the global rate limiter), skipping any file that was completed in a
+    prior run or whose output already exists. Returns a list of (n_triples_in, n_triples_out) for each completed file,
+    in the same order as *files*. A file that fails is logged and left for the next run, without stopping the others.
+    """
+    completed = load_journal()
+    todo = []
+    with open(JOURNAL_PATH, "a") as journal:
+        for fp in files:
+            if fp.name in completed:
+                continue
+            out_path = OUT_DIR / f"{fp.name.split('.')[0]}.jsonl.gz"
+            if out_path.exists():
+                # written by a run before the journal existed, so count the lines to journal it now
+                n_in = sum(1 for _ in read_gzipped_file_raw(fp))
+                n_out = sum(1 for _ in read_gzipped_file_raw(out_path))
+                completed[fp.name] = (n_in, n_out)
+                journal.write(json.dumps({"file": fp.name, "n_in": n_in, "n_out": n_out}) + "\n")
+                continue
+            todo.append(fp)
+    log.info(f"{len(files) - len(todo)} files already processed, {len(todo)} remaining")
+
+    # futures are collected on this thread, so journal writes do not need a lock
+    with (
+        open(JOURNAL_PATH, "a") as journal,
+        concurrent.futures.ThreadPoolExecutor(max_workers=NUM_WORKERS) as executor,
+    ):
+        futures = {executor.submit(process_file, fp): fp for fp in todo}
+        failed = []
+        for future in tqdm.tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+            fp = futures[future]
+            try:
+                n_in, n_out = completed[fp.name] = future.result()
+            except Exception:
+                log.exception(f"Failed to process {fp.name}, it will be retried on the next run")
+                failed.append(fp)
+                continue
+            journal.write(json.dumps({"file": fp.name, "n_in": n_in, "n_out": n_out}) + "\n")
+            journal.flush()
+
+    if failed:
+        log.warning(f"{len(failed)} files failed, run again to retry them")
+    return [completed[fp.name] for fp in files if fp.name in completed]
+
+
 if __name__ == "__main__":
     logging.basicConfig(level=loglevel, format="%(name)s:%(levelname)s: %(message)s")
     OUT_DIR.mkdir(parents=True, exist_ok=True)
+    PARTIAL_DIR.mkdir(exist_ok=True)
     filenames = sorted(glob.glob("*.gz", root_dir=IN_DIR))
     files = [pathlib.Path(IN_DIR, fn) for fn in filenames]
     with tqdm.contrib.logging.logging_redirect_tqdm():
-        results = []
-        for d in tqdm.tqdm(files):
-            results.append(process_file(d))
+        results = run_resumable(files)
 
     kept_distill_count = sum(1 for (i, o) in results if o)
     n_triples_in = sum(i for i, o in results)
     n_triples_out = sum(o for i, o in results)
     print(
         f"Distill complete!\n"
-        f"Instances: {len(filenames)} -> {kept_distill_count}\n"
+        f"Instances: {len(results)}/{len(filenames)} processed -> {kept_distill_count}\n"
         f"Triples: {n_triples_in} -> {n_triples_out}"
     )
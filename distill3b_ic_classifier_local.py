@@ -0,0 +1,209 @@
+"""
+Distill3b (local): Given triples, filter the events in the triples using a locally finetuned IC/OOC classifier on CPU:
+- remove OOC utterances (anything not classified as in-character with >80% confidence)
+
+This is an offline alternative to distill3b_ic_classifier_gpt.py. Rather than classifying each triple on its own, the
+utterances of many triples (across many files) are pooled, sorted by length, and classified in large batches to
+minimize padding.
+
+Input: {"before": [Message...], "commands": [Event...], "after": [Message...]}
+
+Output: {
+    "before": [Message...],
+    "commands": [Event...],
+    "after": [Message...],
+}
+- with `after` filtered to only include IC-classified utterances
+"""
+import argparse
+import glob
+import itertools
+import logging
+import os
+import pathlib
+import time
+
+import torch
+import tqdm.contrib.logging
+from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+from dataset.utils import read_gzipped_file, write_jsonl
+
+IN_DIR = pathlib.Path("extract/experiment3a/")
+OUT_DIR = pathlib.Path("extract/experiment3b/")
+MODEL_DIR = pathlib.Path("models/ic_ooc_1-finetuned/checkpoint-9500")
+
+IC_LABEL_ID = 1  # IC = LABEL_1, OOC = LABEL_0
+IC_THRESHOLD = 0.8
+
+# ===== argparsing =====
+parser = argparse.ArgumentParser(description="Filters OOC utterances from triples using a local CPU classifier.")
+parser.add_argument("-m", "--model-dir", help=f"the finetuned model (default: {MODEL_DIR})", default=MODEL_DIR)
+parser.add_argument("-b", "--batch-size", help="the number of utterances per forward pass", default=64, type=int)
+parser.add_argument(
+    "-f",
+    "--files-per-chunk",
+    help="the number of files whose utterances are pooled and length-sorted together",
+    default=32,
+    type=int,
+)
+parser.add_argument("-t", "--threads", help="the number of torch threads (default: all cores)", type=int)
+parser.add_argument("-q", "--quantize", help="apply int8 dynamic quantization to linear layers", action="store_true")
+parser.add_argument(
+    "--benchmark",
+    help="classify the first N utterances in the input dir, report throughput, and exit",
+    metavar="N",
+    type=int,
+)
+
+log = logging.getLogger("distill3b_local")
+loglevel = logging.INFO
+
+
+def is_obviously_ooc(text: str) -> bool:
+    """Returns whether the text is OOC without needing to be classified (same rules as the GPT classifier)."""
+    return not text or "OOC" in text or "OOG" in text or text.startswith("(")
+
+
+class LocalICClassifier:
+    """Wrapper around a sequence classification model that classifies batches of utterances sorted by length."""
+
+    def __init__(
+        self,
+        model_dir: pathlib.Path,
+        batch_size: int = 64,
+        num_threads: int | None = None,
+        quantize: bool = False,
+        max_length: int = 256,
+    ):
+        self.batch_size = batch_size
+        self.max_length = max_length
+        torch.set_num_threads(num_threads or os.cpu_count() or 1)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        model = AutoModelForSequenceClassification.from_pretrained(model_dir)
+        model.eval()
+        if quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+
+    def predict_ic_probs(self, texts: list[str]) -> list[float]:
+        """Returns P(in-character) for each text, in the order given."""
+        probs = [0.0] * len(texts)
+        # sorting by length means each batch pads to a similar length, which is the bulk of the savings on CPU
+        order = sorted(range(len(texts)), key=lambda idx: len(texts[idx]))
+        for start in range(0, len(order), self.batch_size):
+            batch_idxs = order[start : start + self.batch_size]
+            encoded = self.tokenizer(
+                [texts[idx] for idx in batch_idxs],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="pt",
+            )
+            with torch.inference_mode():
+                logits = self.model(**encoded).logits
+            batch_probs = logits.softmax(dim=-1)[:, IC_LABEL_ID].tolist()
+            for idx, prob in zip(batch_idxs, batch_probs):
+                probs[idx] = prob
+        return probs
+
+
+def filter_triples(triples: list[dict], classifier: LocalICClassifier) -> list[dict | None]:
+    """
+    Given a list of triples (possibly from many files), classify all of their `after` utterances in one pooled call and
+    return the processed triples (None if the triple was discarded) in the same order.
+    """
+    # gather every utterance that needs the model, remembering where it came from
+    to_classify = []
+    for triple_idx, triple in enumerate(triples):
+        for event_idx, event in enumerate(triple["after"]):
+            content = event["content"].strip()
+            if not is_obviously_ooc(content):
+                to_classify.append((triple_idx, event_idx, content))
+
+    probs = classifier.predict_ic_probs([content for *_, content in to_classify])
+    keep = {
+        (triple_idx, event_idx) for (triple_idx, event_idx, _), prob in zip(to_classify, probs) if prob > IC_THRESHOLD
+    }
+
+    out = []
+    for triple_idx, triple in enumerate(triples):
+        triple["after"] = [event for event_idx, event in enumerate(triple["after"]) if (triple_idx, event_idx) in keep]
+        if triple["after"] or triple["before"]:
+            out.append(triple)
+        else:
+            out.append(None)
+    return out
+
+
+def process_files(fps: list[pathlib.Path], classifier: LocalICClassifier) -> list[tuple[int, int]]:
+    """
+    Given a chunk of paths to files containing lists of triples, filter the triples of all the files at once and return
+    a list of (n_triples_in, n_triples_out) pairs, one for each file.
+    """
+    triples_by_file = [list(read_gzipped_file(fp)) for fp in fps]
+    processed = filter_triples(list(itertools.chain.from_iterable(triples_by_file)), classifier)
+
+    results = []
+    offset = 0
+    for fp, triples in zip(fps, triples_by_file):
+        combat_id, *_ = fp.stem.split(".")
+        out = [t for t in processed[offset : offset + len(triples)] if t is not None]
+        offset += len(triples)
+        # discard if we have nothing
+        if out:
+            write_jsonl(OUT_DIR / f"{combat_id}.jsonl.gz", out)
+        results.append((len(triples), len(out)))
+    return results
+
+
+def benchmark(files: list[pathlib.Path], classifier: LocalICClassifier, n: int):
+    """Classifies the first *n* classifiable utterances in *files* and logs the throughput."""
+    texts = []
+    for fp in files:
+        for triple in read_gzipped_file(fp):
+            texts.extend(e["content"].strip() for e in triple["after"] if not is_obviously_ooc(e["content"].strip()))
+        if len(texts) >= n:
+            break
+    texts = texts[:n]
+
+    # warm up so that one-time allocation costs are not counted
+    classifier.predict_ic_probs(texts[: classifier.batch_size])
+    start = time.perf_counter()
+    classifier.predict_ic_probs(texts)
+    elapsed = time.perf_counter() - start
+    print(
+        f"Classified {len(texts)} utterances in {elapsed:.2f}s ({len(texts) / elapsed:.1f} utterances/sec)\n"
+        f"batch_size={classifier.batch_size} threads={torch.get_num_threads()}"
+    )
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logging.basicConfig(level=loglevel, format="%(name)s:%(levelname)s: %(message)s")
+    OUT_DIR.mkdir(parents=True, exist_ok=True)
+    filenames = sorted(glob.glob("*.gz", root_dir=IN_DIR))
+    files = [pathlib.Path(IN_DIR, fn) for fn in filenames]
+    classifier = LocalICClassifier(
+        args.model_dir, batch_size=args.batch_size, num_threads=args.threads, quantize=args.quantize
+    )
+    log.info(f"classifier loaded (quantize={args.quantize}, threads={torch.get_num_threads()})")
+
+    if args.benchmark:
+        benchmark(files, classifier, args.benchmark)
+        raise SystemExit
+
+    chunks = [files[i : i + args.files_per_chunk] for i in range(0, len(files), args.files_per_chunk)]
+    with tqdm.contrib.logging.logging_redirect_tqdm():
+        results = []
+        for chunk in tqdm.tqdm(chunks):
+            results.extend(process_files(chunk, classifier))
+
+    kept_distill_count = sum(1 for (i, o) in results if o)
+    n_triples_in = sum(i for i, o in results)
+    n_triples_out = sum(o for i, o in results)
+    print(
+        f"Distill complete!\n"
+        f"Instances: {len(filenames)} -> {kept_distill_count}\n"
+        f"Triples: {n_triples_in} -> {n_triples_out}"
+    )
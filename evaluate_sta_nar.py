@@ -1,51 +1,234 @@
+"""
+Scores the sta->nar predictions in results/sta-nar-test-results-ready-for-eval.jsonl with perplexity, BLEURT, and
+BERTScore.
+
+Rows are scored in chunks and appended to results/sta-nar-test-results-eval.jsonl as each chunk finishes, so an
+interrupted run resumes after the last complete row (pass --restart to start over). The averages are computed from the
+streamed file at the end.
+"""
+import argparse
+import hashlib
+import json
+import os
 import pathlib
+import sqlite3
+
+import tqdm
 from evaluate import load
-import json
+
 from dataset.utils import read_jsonl_file
-import tqdm
 
 RESULTS_FILE = pathlib.Path("results/sta-nar-test-results-ready-for-eval.jsonl")
 OUT_DIR = pathlib.Path("results")
-PERPLEXITY_MODEL = 'gpt2'
+PERPLEXITY_MODEL = "gpt2"
+BERTSCORE_LANG = "en"
+DEVICE = "cpu"
+BATCH_SIZE = 64
+# scores are cached by (metric, prediction, reference) so adding a new prediction column only scores the new texts
+SCORE_CACHE_PATH = OUT_DIR / "sta-nar-metric-cache.sqlite3"
+EVAL_FILE = OUT_DIR / "sta-nar-test-results-eval.jsonl"
+AVERAGES_FILE = OUT_DIR / "sta-nar-test-results-eval-averages.jsonl"
+PREDICTIONS = ["full", "nostate", "command_utterance", "dialog_continuation"]
+# the number of rows scored and written at a time
+CHUNK_SIZE = 256
+
 
 def writeline(f, d):
     f.write(json.dumps(d))
     f.write("\n")
 
 
-def main():
-    perplexity = load("perplexity", module_type="metric")
-    bleurt = load("bleurt", module_type="metric")
-    bertscore = load("bertscore")
-    metrics = [perplexity, bleurt, bertscore]
-    predictions = ["full", "nostate", "command_utterance", "dialog_continuation"]
-    results = []
-    average_results = {(metric.name, prediction): [] for metric in metrics for prediction in predictions}
-    results_stream = read_jsonl_file(RESULTS_FILE)
-    for data in tqdm.tqdm(results_stream):
-        data["perplexity_gold"] = perplexity.compute(predictions=[data['gold']], model_id=PERPLEXITY_MODEL)['perplexities'][0]
-        for prediction in predictions:
-            pred_str = data[f"prediction_{prediction}"]
+def _digest(prediction: str, reference: str | None) -> bytes:
+    return hashlib.blake2b(json.dumps([prediction, reference]).encode(), digest_size=16).digest()
+
+
+class ScoreCache:
+    """Caches metric scores by (metric config, prediction, reference) in a SQLite DB."""
+
+    def __init__(self, cache_path: pathlib.Path = SCORE_CACHE_PATH):
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(cache_path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS scores (metric TEXT, digest BLOB, score REAL, PRIMARY KEY (metric, digest))"
+        )
+
+    def lookup(self, metric: str, digests: list[bytes]) -> dict[bytes, float]:
+        found = {}
+        # stay under SQLite's bound parameter limit
+        for start in range(0, len(digests), 500):
+            chunk = digests[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.db.execute(
+                f"SELECT digest, score FROM scores WHERE metric = ? AND digest IN ({placeholders})", [metric, *chunk]
+            )
+            found.update(rows)
+        return found
+
+    def store(self, metric: str, scores: dict[bytes, float]):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO scores VALUES (?, ?, ?)", ((metric, d, s) for d, s in scores.items())
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class BatchedMetric:
+    """
+    Wraps a HF evaluate metric so that it scores many (prediction, reference) pairs at once, only computing pairs
+    that are not in the score cache.
+    """
+
+    def __init__(self, metric, cache_key: str, cache: ScoreCache, reference_free: bool = False, **compute_kwargs):
+        self.metric = metric
+        self.name = metric.name
+        self.cache_key = cache_key
+        self.cache = cache
+        self.reference_free = reference_free
+        self.compute_kwargs = compute_kwargs
+
+    def _compute_batch(self, predictions: list[str], references: list[str]) -> list[float]:
+        if self.name == "perplexity":
+            return self.metric.compute(predictions=predictions, **self.compute_kwargs)["perplexities"]
+        result = self.metric.compute(predictions=predictions, references=references, **self.compute_kwargs)
+        if self.name == "bert_score":
+            return result["f1"]
+        return result["scores"]
+
+    def score(self, predictions: list[str], references: list[str] | None = None) -> list[float]:
+        """Returns the score of each prediction (against the reference at the same index), in the order given."""
+        if self.reference_free or references is None:
+            references = [None] * len(predictions)
+        digests = [_digest(p, r) for p, r in zip(predictions, references)]
+        scores = self.cache.lookup(self.cache_key, list(set(digests)))
+
+        # score each distinct missing pair once, in large batches
+        misses = {}
+        for digest, pair in zip(digests, zip(predictions, references)):
+            if digest not in scores:
+                misses[digest] = pair
+        miss_digests = list(misses)
+        for start in tqdm.trange(0, len(miss_digests), BATCH_SIZE, desc=self.name, disable=not miss_digests):
+            batch_digests = miss_digests[start : start + BATCH_SIZE]
+            batch_preds = [misses[d][0] for d in batch_digests]
+            batch_refs = [misses[d][1] for d in batch_digests]
+            new_scores = dict(zip(batch_digests, self._compute_batch(batch_preds, batch_refs)))
+            self.cache.store(self.cache_key, new_scores)
+            scores.update(new_scores)
+
+        return [scores[d] for d in digests]
+
+
+def load_metrics(cache: ScoreCache) -> list[BatchedMetric]:
+    perplexity = BatchedMetric(
+        load("perplexity", module_type="metric"),
+        f"perplexity:{PERPLEXITY_MODEL}",
+        cache,
+        reference_free=True,
+        model_id=PERPLEXITY_MODEL,
+        batch_size=BATCH_SIZE,
+        device=DEVICE,
+    )
+    bleurt = BatchedMetric(load("bleurt", module_type="metric"), "bleurt:default", cache)
+    bertscore = BatchedMetric(
+        load("bertscore"),
+        f"bert_score:{BERTSCORE_LANG}",
+        cache,
+        lang=BERTSCORE_LANG,
+        batch_size=BATCH_SIZE,
+        device=DEVICE,
+    )
+    return [perplexity, bleurt, bertscore]
+
+
+def count_completed_rows(fp: pathlib.Path) -> int:
+    """
+    Returns the number of complete rows in a streamed eval file, truncating a partial last row left by a crash so that
+    the file can be appended to.
+    """
+    if not fp.is_file():
+        return 0
+    n_rows = 0
+    complete_size = 0
+    with open(fp, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            n_rows += 1
+            complete_size += len(line)
+    if complete_size < fp.stat().st_size:
+        with open(fp, "r+b") as f:
+            f.truncate(complete_size)
+    return n_rows
+
+
+def score_chunk(rows: list[dict], metrics: list[BatchedMetric]):
+    """Adds every metric's score for each prediction column to each of the rows (in place)."""
+    perplexity = metrics[0]
+    golds = [data["gold"] for data in rows]
+
+    # each metric runs over all of the chunk's predictions at once, and gold perplexity is only computed once
+    gold_perplexities = perplexity.score(golds)
+    scores = {}
+    pred_strs = [data[f"prediction_{prediction}"] for prediction in PREDICTIONS for data in rows]
+    for metric in metrics:
+        metric_scores = metric.score(pred_strs, golds * len(PREDICTIONS))
+        for i, prediction in enumerate(PREDICTIONS):
+            scores[(metric.name, prediction)] = metric_scores[i * len(rows) : (i + 1) * len(rows)]
+
+    for idx, data in enumerate(rows):
+        data["perplexity_gold"] = gold_perplexities[idx]
+        for prediction in PREDICTIONS:
             for metric in metrics:
-                if metric == perplexity:
-                    result = metric.compute(predictions=[pred_str], model_id=PERPLEXITY_MODEL)['perplexities'][0]
-                elif metric == bertscore:
-                    result = metric.compute(predictions=[pred_str], references=[data['gold']], lang='en')['f1'][0]
-                else:
-                    result = metric.compute(predictions=[pred_str], references=[data['gold']])['scores'][0]
-                data[f"{metric.name}_{prediction}"] = result
-                average_results[(metric.name, prediction)].append(result)
-        results.append(data)
-    with open(OUT_DIR / f"sta-nar-test-results-eval.jsonl", mode="w") as outfile:
-        for result in results:
-            writeline(outfile, result)
-    with open(OUT_DIR / f"sta-nar-test-results-eval-averages.jsonl", mode="w") as outfile:
+                data[f"{metric.name}_{prediction}"] = scores[(metric.name, prediction)][idx]
+
+
+def compute_averages(fp: pathlib.Path, metrics: list[BatchedMetric]) -> dict[tuple[str, str], float]:
+    """Returns the average of each (metric, prediction) over the streamed eval file, with running sums."""
+    keys = [(metric.name, prediction) for metric in metrics for prediction in PREDICTIONS]
+    sums = dict.fromkeys(keys, 0.0)
+    n_rows = 0
+    for data in read_jsonl_file(fp):
+        for metric_name, prediction in keys:
+            sums[(metric_name, prediction)] += data[f"{metric_name}_{prediction}"]
+        n_rows += 1
+    return {key: total / n_rows for key, total in sums.items()}
+
+
+def main(restart: bool = False):
+    if restart and EVAL_FILE.is_file():
+        EVAL_FILE.unlink()
+    n_completed = count_completed_rows(EVAL_FILE)
+    results = list(read_jsonl_file(RESULTS_FILE))
+    if n_completed > len(results):
+        raise RuntimeError(f"{EVAL_FILE} has more rows than {RESULTS_FILE}, rerun with --restart")
+    if n_completed:
+        last_completed = json.loads(EVAL_FILE.read_text().splitlines()[-1])
+        if last_completed["gold"] != results[n_completed - 1]["gold"]:
+            raise RuntimeError(f"{EVAL_FILE} does not match {RESULTS_FILE}, rerun with --restart")
+        print(f"Resuming after {n_completed} completed rows")
+
+    cache = ScoreCache()
+    metrics = load_metrics(cache)
+    with open(EVAL_FILE, mode="a") as outfile:
+        for start in tqdm.trange(n_completed, len(results), CHUNK_SIZE, desc="chunks"):
+            chunk = results[start : start + CHUNK_SIZE]
+            score_chunk(chunk, metrics)
+            for result in chunk:
+                writeline(outfile, result)
+            outfile.flush()
+            os.fsync(outfile.fileno())
+    cache.close()
+
+    average_results = compute_averages(EVAL_FILE, metrics)
+    with open(AVERAGES_FILE, mode="w") as outfile:
         for key, value in average_results.items():
-            writeline(outfile, {"metric": key[0], "prediction": key[1], "average": sum(value)/len(value)})
-    
+            writeline(outfile, {"metric": key[0], "prediction": key[1], "average": value})
 
-if __name__ == "__main__":
-    main()
-                
 
-            
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scores the sta->nar test predictions.")
+    parser.add_argument("--restart", help="discard any partial eval file instead of resuming", action="store_true")
+    args = parser.parse_args()
+    main(restart=args.restart)
@@ -1,33 +1,90 @@
 import type {RPToCommandDistill, StateToNarrationDistill, TimeBasedDistill} from "@/avrae/distill";
 import type {AnyEvent} from "@/events";
-import {parseJSONStream, splitStreamOn} from "@/utils";
+import {parseJSONStream, SortOrder, splitStreamOn} from "@/utils";
 
 type HeuristicScoreMap = { [heuristicId: string]: number };
+type NullableHeuristicScoreMap = { [heuristicId: string]: number | null };
 type InstanceHeuristicMap = { [instanceId: string]: HeuristicScoreMap };
 
 
 const API_BASE = import.meta.env.VITE_API_URL;
+const STATUS_POLL_INTERVAL = 2000;  // ms
 
 // ===== api types =====
 interface IndexModel {
-    checksum: string;
+    checksum: string | null;  // null until the server has computed it
     instances: string[];
     heuristics: string[];
+    heuristics_validated: boolean;  // false until the heuristics have been checked against the checksum
+}
+
+export interface DatasetStatus {
+    phase: string;
+    ready: boolean;
+    elapsed: number;
+    error: string | null;
+    checksum: string | null;
+    instances: number;
+    heuristics_loaded: number;
+    heuristic_results: number;
+    heuristics_validated: boolean;
+}
+
+export interface HeuristicQuery {
+    sort?: [string, SortOrder][];  // heuristic id (or "_id") and direction, in priority order
+    ranges?: { [heuristicId: string]: [number | null, number | null] };  // inclusive min, max
+    prefix?: string;
+    page?: number;
+    limit?: number;
+}
+
+export interface EventQuery {
+    offset?: number;
+    limit?: number;
+    eventType?: string;
+}
+
+export interface EventsInfo {
+    total: number;
+    event_types: { [eventType: string]: number };
+}
+
+export interface HeuristicQueryResult {
+    total: number;
+    page: number;
+    limit: number;
+    instances: [string, NullableHeuristicScoreMap][];
 }
 
 // ===== client ====
 export class DatasetClient {
     public indexLoaded: boolean = false;
     public heuristicsLoaded: boolean = false;
-    public checksum: string = "";
+    public checksum: string | null = null;
     public instanceIds: string[] = [];
     public heuristicIds: string[] = [];
     public heuristicsByInstance: InstanceHeuristicMap = {};
+    public status: DatasetStatus | null = null;
     public apiBase = API_BASE;
 
     public async init() {
-        await this.loadIndex();
-        await this.loadHeuristicsByInstance();
+        // heuristics are queried a page at a time (see queryHeuristics), so we don't load them all here
+        // the server loads the dataset in the background, so refresh the index until it's done
+        while (true) {
+            await this.loadStatus();
+            await this.loadIndex();
+            if (!this.status || this.status.ready || this.status.error) break;
+            await new Promise(resolve => setTimeout(resolve, STATUS_POLL_INTERVAL));
+        }
+    }
+
+    async loadStatus() {
+        const response = await fetch(`${API_BASE}/status`);
+        if (response.ok) {
+            this.status = await response.json();
+        } else {
+            console.error(`Failed to load the dataset status: ${response.status} ${response.statusText}`);
+        }
     }
 
     async loadIndex() {
@@ -55,6 +112,37 @@ export class DatasetClient {
         }
     }
 
+    async queryHeuristics(query: HeuristicQuery): Promise<HeuristicQueryResult | null> {
+        const params = new URLSearchParams();
+        for (const [sorterKey, direction] of query.sort ?? []) {
+            params.append("sort", `${sorterKey}:${direction}`);
+        }
+        for (const [heuristicId, [min, max]] of Object.entries(query.ranges ?? {})) {
+            params.append("filter", `${heuristicId}:${min ?? ""}:${max ?? ""}`);
+        }
+        if (query.prefix) params.set("prefix", query.prefix);
+        if (query.page !== undefined) params.set("page", query.page.toString());
+        if (query.limit !== undefined) params.set("limit", query.limit.toString());
+
+        const response = await fetch(`${API_BASE}/heuristics/query?${params}`);
+        if (response.ok) {
+            return await response.json();
+        } else {
+            console.error(`Failed to query heuristics: ${response.status} ${response.statusText}`);
+            return null;
+        }
+    }
+
+    async loadHeuristicsForInstance(instanceId: string): Promise<HeuristicScoreMap | null> {
+        const response = await fetch(`${API_BASE}/heuristics/${instanceId}`);
+        if (response.ok) {
+            return await response.json();
+        } else {
+            console.error(`Failed to load instance heuristics: ${response.status} ${response.statusText}`);
+            return null;
+        }
+    }
+
     private async* eventsFromStream<T>(stream: ReadableStream<Uint8Array>): AsyncGenerator<T> {
         // stream transform code adapted from https://streams.spec.whatwg.org/demos/append-child.html
         // see "WHATWG Streams Standard" in licenses.txt
@@ -72,8 +160,23 @@ export class DatasetClient {
         }
     }
 
-    async* loadEventsForInstance(instanceId: string): AsyncGenerator<AnyEvent> {
-        const response = await fetch(`${API_BASE}/events/${instanceId}`);
+    async loadEventsInfo(instanceId: string): Promise<EventsInfo | null> {
+        const response = await fetch(`${API_BASE}/events/${instanceId}/info`);
+        if (response.ok) {
+            return await response.json();
+        } else {
+            console.error(`Failed to load instance events info: ${response.status} ${response.statusText}`);
+            return null;
+        }
+    }
+
+    async* loadEventsForInstance(instanceId: string, query: EventQuery = {}): AsyncGenerator<AnyEvent> {
+        // the server only sends the requested range of events
+        const params = new URLSearchParams();
+        if (query.offset !== undefined) params.set("offset", query.offset.toString());
+        if (query.limit !== undefined) params.set("limit", query.limit.toString());
+        if (query.eventType) params.set("event_type", query.eventType);
+        const response = await fetch(`${API_BASE}/events/${instanceId}?${params}`);
         if (response.ok && response.body) {
             yield* await this.eventsFromStream<AnyEvent>(response.body);
         } else {
@@ -1,16 +1,28 @@
-import csv
-import io
+import asyncio
+import gzip
+import hashlib
+import json
 import logging
 import os
 import pathlib
+import sqlite3
+import threading
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse, StreamingResponse
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 
 import dataset.utils
 from dataset.dataset import Dataset
+from dataset.event_index import EventIndexCache, iter_chunks
+from dataset.payload_cache import PayloadCache, files_signature
+from dataset.search_index import SearchIndex, to_match_query
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 log = logging.getLogger("explorer_server")
 
@@ -19,10 +31,20 @@ DATA_DIR = pathlib.Path(os.getenv("DATA_DIR", "data/"))
 HEURISTIC_DIR = pathlib.Path(os.getenv("HEURISTIC_DIR", "heuristic_results/"))
 RP_EXTRACT_DIR = pathlib.Path("extract/rp/")
 NARRATION_EXTRACT_DIR = pathlib.Path("extract/narration/")
+# uncompressed copies of instances + event offset indexes, for /events and /distill requests
+EVENT_CACHE_DIR = pathlib.Path(os.getenv("EVENT_CACHE_DIR", "extract/explorer_cache/"))
+# the most recently used uncompressed copies are also kept in memory, up to this many bytes in total
+EVENT_CACHE_MAX_MEMORY = int(os.getenv("EVENT_CACHE_MAX_MEMORY", 512 * 1024 * 1024))
+# and the uncompressed copies on disk are limited to this many bytes in total (least recently used are deleted first)
+EVENT_CACHE_MAX_DISK = int(os.getenv("EVENT_CACHE_MAX_DISK", 20 * 1024 * 1024 * 1024))
+# full-text index of messages and commands, built by build_search_index.py
+SEARCH_INDEX_PATH = pathlib.Path(os.getenv("SEARCH_INDEX_PATH", "extract/search_index.sqlite3"))
 
 # ===== app =====
 app = FastAPI()
 state = Dataset(DATA_DIR, HEURISTIC_DIR)
+payload_cache = PayloadCache(EVENT_CACHE_DIR, EVENT_CACHE_MAX_MEMORY, EVENT_CACHE_MAX_DISK)
+event_index = EventIndexCache(DATA_DIR, EVENT_CACHE_DIR, payload_cache)
 
 app.add_middleware(
     CORSMiddleware,
@@ -30,14 +52,119 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Total-Count"],
 )
 
 app.mount("/explorer", StaticFiles(directory="explorer/dist", html=True), name="explorer")
 
 
+# ===== precomputed responses =====
+class PrecomputedResponse:
+    """
+    A response body that is serialized and compressed once, then served with a strong ETag (so unchanged bodies get a
+    304) in the best encoding the client accepts.
+    """
+
+    def __init__(self, body: bytes, media_type: str, headers: dict[str, str] = None):
+        self.media_type = media_type
+        self.headers = headers or {}
+        self.etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        self.bodies = {"identity": body, "gzip": gzip.compress(body, compresslevel=9)}
+        if brotli is not None:
+            self.bodies["br"] = brotli.compress(body)
+
+    def negotiate_encoding(self, accept_encoding: str) -> str:
+        """Returns the smallest encoding we have that the Accept-Encoding header allows (ignoring q-value ordering)."""
+        accepted = set()
+        for part in accept_encoding.split(","):
+            coding, *params = part.split(";")
+            q = 1.0
+            for param in params:
+                name, _, value = param.strip().partition("=")
+                if name == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0
+            if q > 0:
+                accepted.add(coding.strip().lower())
+        for encoding in ("br", "gzip"):
+            if encoding in self.bodies and (encoding in accepted or "*" in accepted):
+                return encoding
+        return "identity"
+
+    def respond(self, request: Request) -> Response:
+        headers = {**self.headers, "ETag": self.etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+        if_none_match = request.headers.get("if-none-match", "")
+        if self.etag in (tag.strip() for tag in if_none_match.split(",")) or if_none_match.strip() == "*":
+            return Response(status_code=304, headers=headers)
+
+        encoding = self.negotiate_encoding(request.headers.get("accept-encoding", ""))
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return Response(content=self.bodies[encoding], media_type=self.media_type, headers=headers)
+
+
+precomputed = {}
+precomputed_lock = threading.Lock()
+
+
+def build_heuristic_responses():
+    """Serializes the heuristics (as JSON and CSV) once. Call this again whenever the heuristics are reloaded."""
+    # same serialization as FastAPI's JSONResponse
+    heuristics_json = json.dumps(
+        state.heuristics_by_instance, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")
+    )
+    precomputed["heuristics"] = PrecomputedResponse(heuristics_json.encode(), media_type="application/json")
+
+    heuristics_csv = state.instance_heuristics_df.to_csv(index_label="instance_id", lineterminator="\r\n")
+    precomputed["heuristics_csv"] = PrecomputedResponse(
+        heuristics_csv.encode(),
+        media_type="text/csv",
+        headers={"Content-Disposition": "attachment; filename=export.csv"},
+    )
+    for name, response in precomputed.items():
+        sizes = ", ".join(f"{encoding}={len(body)}B" for encoding, body in response.bodies.items())
+        log.debug(f"Precomputed /{name} response ({sizes})")
+
+
+def get_precomputed(name: str) -> PrecomputedResponse:
+    """Returns a precomputed response, (re)building the responses first if the heuristics changed since."""
+    with precomputed_lock:
+        if name not in precomputed:
+            build_heuristic_responses()
+        return precomputed[name]
+
+
+def on_heuristics_update():
+    # serializing everything is slow, so during init the responses are only rebuilt if they are requested
+    with precomputed_lock:
+        precomputed.clear()
+    # precompute the sort orders for /heuristics/query
+    _ = state.sort_permutations
+
+
+def init_state():
+    state.init(on_heuristics_update)
+    with precomputed_lock:
+        build_heuristic_responses()
+
+
+init_task = None
+
+
 @app.on_event("startup")
 async def startup_event():
-    state.init()
+    global init_task
+    # the checksum and heuristic results take a while to load, so load them in the background while we serve requests
+    # (see /status for progress); each heuristic is available as soon as it loads
+    init_task = asyncio.get_running_loop().run_in_executor(None, init_state)
+    init_task.add_done_callback(log_init_result)
+
+
+def log_init_result(future: asyncio.Future):
+    if future.exception() is not None:
+        log.error("Dataset init failed!", exc_info=future.exception())
 
 
 # ===== api routes =====
@@ -46,55 +173,170 @@ async def root():
     return RedirectResponse("/explorer")
 
 
+@app.get("/status")
+async def status():
+    """
+    Returns the progress of the dataset init. Until it is ready, the index only has the heuristics loaded so far, and the
+    checksum is null until it has been computed. The heuristics are provisional (some may have been computed over a
+    different version of the dataset) until heuristics_validated is true.
+    """
+    return state.status()
+
+
 @app.get("/index")
 async def index():
-    """Returns the dataset index (checksum, list of instance ids, list of heuristic ids)"""
-    return {"checksum": state.dataset_checksum, "instances": state.instance_ids, "heuristics": state.heuristic_ids}
+    """
+    Returns the dataset index (checksum, list of instance ids, list of heuristic ids). Until heuristics_validated is
+    true, the heuristics have not been checked against the dataset checksum yet (see /status).
+    """
+    return {
+        "checksum": state.dataset_checksum,
+        "instances": state.instance_ids,
+        "heuristics": state.heuristic_ids,
+        "heuristics_validated": state.heuristics_validated,
+    }
 
 
 @app.get("/heuristics")
-async def instance_heuristics() -> dict[str, dict[str, float]]:
+def instance_heuristics(request: Request):
     """Returns all of the computed heuristics. (instance id -> (heuristic id -> score))"""
-    return state.heuristics_by_instance
+    return get_precomputed("heuristics").respond(request)
 
 
 @app.get("/heuristics/csv")
-async def get_heuristics_table():
+def get_heuristics_table(request: Request):
     """Returns all of the computed heuristics in a CSV table."""
-    csvbuf = io.StringIO()
-
-    writer = csv.DictWriter(csvbuf, fieldnames=("instance_id", *state.heuristic_ids))
-    writer.writeheader()
-    for instance_id, row in state.heuristics_by_instance.items():
-        writer.writerow({"instance_id": instance_id, **row})
-
-    csvbuf.seek(0)
-    response = StreamingResponse(
-        csvbuf,
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=export.csv"},
-    )
-    return response
+    return get_precomputed("heuristics_csv").respond(request)
+
+
+@app.get("/heuristics/query")
+def query_heuristics(
+    sort: list[str] = Query(default=[]),
+    filter: list[str] = Query(default=[]),
+    prefix: str = "",
+    page: int = Query(default=0, ge=0),
+    limit: int = Query(default=250, ge=1, le=1000),
+):
+    """
+    Returns one page of instances' heuristics, sorted and filtered server-side.
+
+    - sort: "{heuristic id or _id}:{1 (asc) or 2 (desc)}", in priority order (may be repeated)
+    - filter: "{heuristic id}:{min}:{max}", inclusive; either bound may be empty (may be repeated)
+    - prefix: only include instance IDs starting with this
+    """
+    sorters = []
+    for sort_elem in sort:
+        key, _, direction = sort_elem.partition(":")
+        if direction not in ("1", "2"):
+            raise HTTPException(status_code=400, detail=f"invalid sort: {sort_elem!r}")
+        sorters.append((key, direction == "2"))
+    ranges = {}
+    for filter_elem in filter:
+        try:
+            heuristic_id, lo, hi = filter_elem.split(":")
+            ranges[heuristic_id] = (float(lo) if lo else None, float(hi) if hi else None)
+        except ValueError:
+            raise HTTPException(status_code=400, detail=f"invalid filter: {filter_elem!r}")
+
+    total, instances = state.query_heuristics(sorters, ranges, prefix, page, limit)
+    return {"total": total, "page": page, "limit": limit, "instances": instances}
+
+
+@app.get("/heuristics/{instance_id}")
+def get_instance_heuristics(instance_id: str) -> dict[str, float]:
+    """Returns the computed heuristics for one instance. (heuristic id -> score)"""
+    instance_heuristics = state.get_instance_heuristics(instance_id)
+    if instance_heuristics is None:
+        raise HTTPException(status_code=404, detail="instance does not exist")
+    return instance_heuristics
 
 
 @app.get("/events/{instance_id}")
-def get_instance_events(instance_id: str):
-    """Returns a streaming response of events, with each chunk being a list of events."""
+def get_instance_events(
+    instance_id: str,
+    offset: int = Query(default=0, ge=0),
+    limit: int | None = Query(default=None, ge=0),
+    event_type: str | None = None,
+):
+    """
+    Returns a streaming response of events, with each chunk being a list of events. Pass offset/limit/event_type to
+    only get a range of the (matching) events; the X-Total-Count header has the total number of matching events.
+    """
     if instance_id not in state.instance_ids:
         raise HTTPException(status_code=404, detail="instance does not exist")
-    # stream the response in order to reduce memory usage (big instances can be 250MB+, don't consume entire iterator)
+    if offset == 0 and limit is None and event_type is None:
+        # the whole instance doesn't need the index, just the cached uncompressed copy
+        # (big instances can be 250MB+, stream it in chunks)
+        if event_index.is_payload_cached(instance_id):
+            return StreamingResponse(
+                iter_chunks(event_index.get_payload(instance_id)), media_type="application/jsonl+json"
+            )
+        # not cached yet: stream the raw files as they decompress rather than waiting for the whole copy to be built
+        # (it is built by the first ranged or /info request)
+        return StreamingResponse(
+            dataset.utils.combat_dir_iterator_raw(state.data_dir_path / instance_id),
+            media_type="application/jsonl+json",
+        )
+    # ranged requests slice the uncompressed copy, skipping the events outside the range without reading them
+    total, event_idxs = event_index.select(instance_id, offset, limit, event_type)
     return StreamingResponse(
-        dataset.utils.combat_dir_iterator_raw(state.data_dir_path / instance_id), media_type="application/jsonl+json"
+        event_index.read_events(instance_id, event_idxs),
+        media_type="application/jsonl+json",
+        headers={"X-Total-Count": str(total)},
     )
 
 
+@app.get("/events/{instance_id}/info")
+def get_instance_events_info(instance_id: str):
+    """Returns the number of events in the instance, in total and by event type."""
+    if instance_id not in state.instance_ids:
+        raise HTTPException(status_code=404, detail="instance does not exist")
+    index = event_index.get_index(instance_id)
+    return {"total": len(index), "event_types": index.event_type_counts()}
+
+
+@app.get("/search")
+def search(
+    q: str = Query(min_length=1),
+    raw: bool = False,
+    instance_id: str | None = None,
+    event_type: str | None = None,
+    page: int = Query(default=0, ge=0),
+    limit: int = Query(default=50, ge=1, le=500),
+):
+    """
+    Returns one page of the messages and commands matching a query, best match first. Each hit has its instance ID and
+    its position in the instance's events (use it as the offset of /events/{instance_id}).
+
+    - q: the words to search for (all must match); if raw is true, a SQLite FTS5 query instead (e.g. phrases, OR,
+      prefixes, or column filters like "command_name: cast")
+    - instance_id, event_type: only search one instance / event type ("message" or "command")
+    """
+    if not SEARCH_INDEX_PATH.exists():
+        raise HTTPException(status_code=503, detail="search index has not been built (run build_search_index.py)")
+    match = q if raw else to_match_query(q)
+    index = SearchIndex(SEARCH_INDEX_PATH, readonly=True)
+    try:
+        total, hits = index.search(match, instance_id, event_type, offset=page * limit, limit=limit)
+    except sqlite3.OperationalError as e:
+        raise HTTPException(status_code=400, detail=f"invalid query: {e}")
+    finally:
+        index.close()
+    return {"total": total, "page": page, "limit": limit, "hits": [hit._asdict() for hit in hits]}
+
+
 def get_distilled_instance(basepath: pathlib.Path, instance_id: str):
     if instance_id not in state.instance_ids:
         raise HTTPException(status_code=404, detail="instance does not exist")
     distill_path = basepath / f"{instance_id}.jsonl.gz"
     if not distill_path.exists():
         raise HTTPException(status_code=404, detail="instance is not distilled")
-    return StreamingResponse(dataset.utils.read_gzipped_file_raw(distill_path), media_type="application/jsonl+json")
+    payload = payload_cache.get(
+        f"{basepath.name}-{instance_id}",
+        files_signature([distill_path]),
+        lambda: dataset.utils.read_gzipped_file_raw(distill_path),
+    )
+    return StreamingResponse(iter_chunks(payload), media_type="application/jsonl+json")
 
 
 # @app.get("/distill/rp/{instance_id}")
@@ -116,6 +358,12 @@ def get_instance_experiment1_distill(instance_id: str):
     return get_distilled_instance(pathlib.Path("extract/experiment1/"), instance_id)
 
 
+@app.get("/cache/stats")
+async def get_cache_stats():
+    """Returns the hit/miss counts and memory usage of the uncompressed instance cache."""
+    return payload_cache.stats()
+
+
 # todo endpoints to save notes and -2 to +2 scores for each instance
 # todo endpoints to retrieve those notes
 # todo sqlite db to save those
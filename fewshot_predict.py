@@ -1,79 +1,61 @@
-import glob
-import json
-import logging
-import pathlib
 import os
-from time import sleep
+import pathlib
 
-import tqdm.contrib.logging
+import openai
 
 import prompts
-from dataset.utils import read_jsonl_file
-import openai
+from prediction_engine import PredictionTask, run_cli
+
 openai.organization = "org-bgAXfs8WdU5942SLngg0OGpd"
 openai.api_key = os.getenv("OPENAI_API_KEY")
 NORMALIZED_IN_DIR = pathlib.Path("extract/")
 PROMPT_DIR = pathlib.Path("few-shot/prompts")
 NUM_SHOTS = 3
 OUT_DIR = pathlib.Path("few-shot")
-FT_MODEL = 'code-davinci-002'
-FT_MODEL_STR = 'code'
-# FT_MODEL = 'text-davinci-002'
-# FT_MODEL_STR = "text"
-
-text_file = open(PROMPT_DIR / pathlib.Path(f'utt-cmd-full-{NUM_SHOTS}.txt'), "r")
-fewshot_prompt_full = text_file.read()
-text_file.close()
-text_file = open(PROMPT_DIR / pathlib.Path(f'utt-cmd-nostate-{NUM_SHOTS}.txt'), "r")
-fewshot_prompt_nostate = text_file.read()
-text_file.close()
-
-def writeline(f, d):
-    f.write(json.dumps(d))
-    f.write("\n")
-def main():
-    test_file = NORMALIZED_IN_DIR / pathlib.Path('ft-utt-cmd-test-1000.jsonl')
-    test_stream = read_jsonl_file(test_file)
-    predictions = []
-    for data in tqdm.tqdm(test_stream):
-        prompt_full = fewshot_prompt_full + prompts.utt_cmd_prompt(data)
-        completion_full = openai.Completion.create(
-            model=FT_MODEL,
-            prompt=prompt_full,
-            temperature=0.2,
-            max_tokens=128,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=["\n<|aeot|>"],
-        )
-        data['prediction_full'] = completion_full['choices'][0]['text']
-        predictions.append(data)
-        prompt_nostate = fewshot_prompt_nostate + prompts.utt_cmd_prompt(data, ablations=["actors", "current"])
-        completion_nostate = openai.Completion.create(
-            model=FT_MODEL,
-            prompt=prompt_nostate,
-            temperature=0.2,
-            max_tokens=128,
-            top_p=1,
-            frequency_penalty=0,
-            presence_penalty=0,
-            stop=["\n<|aeot|>"],
-        )
-        data['prediction_nostate'] = completion_nostate['choices'][0]['text']
-        if FT_MODEL_STR == 'code': sleep(6) # rate limit for codex
-
-
-        
-
-    testf = open(OUT_DIR / f"utt-cmd-{FT_MODEL_STR}-{NUM_SHOTS}-shot-test-predictions.jsonl", mode="w")
-    for prompt in predictions:
-        writeline(testf, prompt)
-    testf.close()
-    # testf = open(OUT_DIR / f"utt-cmd-fewshot-test-predictions-nostate.jsonl", mode="w")
-    # for prompt in predictions_nostate:
-    #     writeline(testf, prompt)
-    # testf.close()    
+# model name -> short name used in the result file name
+FEWSHOT_MODELS = {
+    "code-davinci-002": "code",
+    "text-davinci-002": "text",
+}
+
+
+class FewShotPrompter:
+    """Prepends the few-shot examples in *prompt_file* to the utt->cmd prompt."""
+
+    def __init__(self, prompt_file: pathlib.Path, ablations=None):
+        self.prompt_file = prompt_file
+        self.ablations = ablations or []
+        self._examples = None
+
+    def __call__(self, data) -> str | None:
+        # the example file is read on first use so that other tasks can run without it
+        if self._examples is None:
+            self._examples = self.prompt_file.read_text()
+        prompt = prompts.utt_cmd_prompt(data, ablations=self.ablations)
+        if prompt is None:
+            return None
+        return self._examples + prompt
+
+
+def make_task(model: str, model_str: str) -> PredictionTask:
+    return PredictionTask(
+        test_data_file=NORMALIZED_IN_DIR / "ft-utt-cmd-test-1000.jsonl",
+        result_file=OUT_DIR / f"utt-cmd-{model_str}-{NUM_SHOTS}-shot-test-predictions.jsonl",
+        model=model,
+        prompters={
+            "prediction_full": FewShotPrompter(PROMPT_DIR / f"utt-cmd-full-{NUM_SHOTS}.txt"),
+            "prediction_nostate": FewShotPrompter(
+                PROMPT_DIR / f"utt-cmd-nostate-{NUM_SHOTS}.txt", ablations=["actors", "current"]
+            ),
+        },
+        temperature=0.2,
+        max_tokens=128,
+        strip=False,
+    )
+
+
+TASKS = {model_str: make_task(model, model_str) for model, model_str in FEWSHOT_MODELS.items()}
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # codex is heavily rate limited; run with e.g. `--rpm 20` rather than sleeping between requests
+    run_cli(TASKS, description="Gets few-shot utt->cmd predictions for the test set.")
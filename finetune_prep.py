@@ -1,30 +1,34 @@
+import collections
+import functools
 import glob
 import json
 import logging
 import pathlib
+import random
+import time
+from typing import Callable, NamedTuple
 
 import sklearn.model_selection
+import tqdm.contrib.concurrent
 import tqdm.contrib.logging
 
 import prompts
+import token_counts
 from dataset.utils import read_jsonl_file
 
 NORMALIZED_IN_DIR = pathlib.Path("extract/experiment4/")
 OUT_DIR = pathlib.Path("extract/")
 
-
 # NORMALIZED_IN_DIR = pathlib.Path("extract/regression/experiment4/")
 # OUT_DIR = pathlib.Path("extract/regression")
 
+# sample with bounded memory (reservoir sampling) instead of materializing every pair; the sampled pairs differ from the
+# in-memory mode (so the released train/test files can only be regenerated in the in-memory mode) but are deterministic
+# for the seed
+STREAMING = False
+RUN_PARALLEL = True
 
-def _map_to_instance(fp: pathlib.Path, f):
-    out = []
-    norm_stream = read_jsonl_file(fp)
-    for data in norm_stream:
-        result = f(data)
-        if result:
-            out.append(result)
-    return out
+log = logging.getLogger("finetune_prep")
 
 
 def _prompt_and_completion(data, prompter, completer) -> dict | None:
@@ -48,163 +52,219 @@ def _extract_dict_keys(data, required_keys, keys, **add_data) -> dict | None:
     return out
 
 
-def process_utt_cmd_train(fp: pathlib.Path, ablations=None):
-    """
-    Transforms each normalized datum into a GPT-3 prompt and completion (see prompts.py for the prompt).
-    """
+# ===== per-datum processors =====
+# these must be module-level functions (or partials of them) so that variants can be pickled
+def utt_cmd_train_pair(data, ablations=None) -> dict | None:
+    """Transforms a normalized datum into a GPT-3 prompt and completion (see prompts.py for the prompt)."""
     if ablations is None:
         ablations = []
-    return _map_to_instance(
-        fp,
-        lambda data: _prompt_and_completion(
-            data,
-            prompter=lambda data: prompts.utt_cmd_prompt(data, ablations=ablations),
-            completer=prompts.utt_cmd_completion,
-        ),
+    return _prompt_and_completion(
+        data,
+        prompter=functools.partial(prompts.utt_cmd_prompt, ablations=ablations),
+        completer=prompts.utt_cmd_completion,
     )
 
 
-def process_utt_cmd_test(fp: pathlib.Path):
+def utt_cmd_test_datum(data, instance_id) -> dict | None:
     """
     Extracts the available keys for this task from the normalized datum.
     X: ("before_utterances", "combat_state_before", "current_actor", "before_idxs", "before_state_idx")
     y: ("commands_norm",)
     """
-    return _map_to_instance(
-        fp,
-        lambda data: _extract_dict_keys(
-            data,
-            required_keys=("before_utterances",),
-            keys=(
-                "combat_state_before",
-                "current_actor",
-                "commands_norm",
-                "speaker_id",
-                "before_idxs",
-                "before_state_idx",
-            ),
-            instance_id=fp.stem,
+    return _extract_dict_keys(
+        data,
+        required_keys=("before_utterances",),
+        keys=(
+            "combat_state_before",
+            "current_actor",
+            "commands_norm",
+            "speaker_id",
+            "before_idxs",
+            "before_state_idx",
         ),
+        instance_id=instance_id,
     )
 
 
-def process_sta_nar_train(fp: pathlib.Path, ablations=None):
+def sta_nar_train_pair(data, ablations=None) -> dict | None:
     if ablations is None:
         ablations = []
-    return _map_to_instance(
-        fp,
-        lambda data: _prompt_and_completion(
-            data,
-            prompter=lambda data: prompts.sta_nar_prompt(data, ablations=ablations),
-            completer=prompts.sta_nar_completion,
-        ),
+    return _prompt_and_completion(
+        data,
+        prompter=functools.partial(prompts.sta_nar_prompt, ablations=ablations),
+        completer=prompts.sta_nar_completion,
     )
 
 
-def process_sta_nar_command_utterance_train(fp: pathlib.Path):
-    return _map_to_instance(
-        fp,
-        lambda data: _prompt_and_completion(
-            data,
-            prompter=prompts.sta_nar_command_utterance_prompt,
-            completer=prompts.sta_nar_completion,
-        ),
+def sta_nar_command_utterance_train_pair(data) -> dict | None:
+    return _prompt_and_completion(
+        data,
+        prompter=prompts.sta_nar_command_utterance_prompt,
+        completer=prompts.sta_nar_completion,
     )
 
 
-def process_sta_nar_dialog_continuation_train(fp: pathlib.Path):
-    return _map_to_instance(
-        fp,
-        lambda data: _prompt_and_completion(
-            data,
-            prompter=prompts.sta_nar_dialog_continuation_prompt,
-            completer=prompts.sta_nar_completion,
-        ),
+def sta_nar_dialog_continuation_train_pair(data) -> dict | None:
+    return _prompt_and_completion(
+        data,
+        prompter=prompts.sta_nar_dialog_continuation_prompt,
+        completer=prompts.sta_nar_completion,
     )
 
 
-def process_sta_nar_test(fp: pathlib.Path):
+def sta_nar_test_datum(data, instance_id) -> dict | None:
     """
     Extracts the available keys for this task from the normalized datum.
     X: ("combat_state_after", "caster_after", "targets_after", "automation_results", "before_idxs", "before_state_idx",
         "command_idxs", "after_state_idx", "after_idxs")
     y: ("after_utterances",)
     """
-    return _map_to_instance(
-        fp,
-        lambda data: _extract_dict_keys(
-            data,
-            required_keys=("after_utterances", "automation_results"),
-            keys=(
-                "commands_norm",
-                "combat_state_after",
-                "caster_after",
-                "targets_after",
-                "speaker_id",
-                "before_idxs",
-                "before_state_idx",
-                "command_idxs",
-                "after_state_idx",
-                "after_idxs",
-                "embed_idxs",
-                "utterance_history",
-            ),
-            instance_id=fp.stem,
+    return _extract_dict_keys(
+        data,
+        required_keys=("after_utterances", "automation_results"),
+        keys=(
+            "commands_norm",
+            "combat_state_after",
+            "caster_after",
+            "targets_after",
+            "speaker_id",
+            "before_idxs",
+            "before_state_idx",
+            "command_idxs",
+            "after_state_idx",
+            "after_idxs",
+            "embed_idxs",
+            "utterance_history",
         ),
+        instance_id=instance_id,
     )
 
 
+# ===== eligibility =====
+# cheap checks of whether the processors above would return a result, without rendering the prompt
+def utt_cmd_eligible(data) -> bool:
+    return bool(data["before_utterances"])
+
+
+def sta_nar_train_eligible(data) -> bool:
+    return bool(data["after_utterances"])
+
+
+def sta_nar_test_eligible(data) -> bool:
+    return bool(data["after_utterances"] and data["automation_results"])
+
+
+class PrepVariant(NamedTuple):
+    """
+    One finetune dataset to generate. *train_fn* maps a datum to a pair, *test_fn* maps (datum, instance id).
+    *train_eligible* and *test_eligible* are only used in streaming mode; if not given, the datum is rendered to check.
+    """
+
+    file_name: str
+    train_fn: Callable[[dict], dict | None]
+    test_fn: Callable[[dict, str], dict | None]
+    desired_train_pairs: int = 10000
+    desired_test_pairs: int = 10000
+    train_epochs: int = 4
+    write_test_file: bool = True
+    train_eligible: Callable[[dict], bool] | None = None
+    test_eligible: Callable[[dict], bool] | None = None
+
+    @property
+    def test_frac(self) -> float:
+        # split the dataset roughly proportionally to the desired train/test split
+        return self.desired_test_pairs / (self.desired_train_pairs + self.desired_test_pairs)
+
+
 def writeline(f, d):
     f.write(json.dumps(d))
     f.write("\n")
 
 
-def do_prep(
-    paths,
-    train_processor,
-    test_processor,
-    file_name,
-    desired_train_pairs=10000,
-    desired_test_pairs=10000,
-    train_epochs=4,
-    write_test_file=True,
-):
-    random_seed = 42
-    # split the dataset roughly proportionally to the desired train/test split
-    test_frac = desired_test_pairs / (desired_train_pairs + desired_test_pairs)
-    paths_train, paths_test = sklearn.model_selection.train_test_split(
-        paths, test_size=test_frac, random_state=random_seed
-    )
+class _TestFn(NamedTuple):
+    """Marks a test function, which also takes the instance ID."""
+
+    fn: Callable[[dict, str], dict | None]
+
+
+def _prep_file(fp: pathlib.Path, fns: list[Callable]) -> list[list]:
+    """
+    Reads the normalized file at *fp* once and applies each of *fns* to each datum. Returns one list of results per
+    function, in the same order as *fns*.
+    """
+    instance_id = fp.stem
+    out = [[] for _ in fns]
+    for data in read_jsonl_file(fp):
+        for fn, results in zip(fns, out):
+            result = fn(data) if not isinstance(fn, _TestFn) else fn.fn(data, instance_id)
+            if result:
+                results.append(result)
+    return out
+
+
+def _prep_file_task(task: tuple[pathlib.Path, list[Callable]]) -> list[list]:
+    """Multiprocessing worker entrypoint for _prep_file."""
+    return _prep_file(*task)
+
+
+def _render_lines_task(task: tuple[pathlib.Path, dict[int, list], dict[tuple, Callable]]) -> dict[tuple, dict | None]:
+    """
+    Multiprocessing worker entrypoint for the streaming mode's second pass. Given a path, a map of line index -> the
+    (variant idx, is_train) keys that sampled it, and the function of each key, returns a map of (variant idx, is_train,
+    line idx) -> rendered pair.
+    """
+    fp, wanted_lines, fns = task
+    out = {}
+    with open(fp) as f:
+        for line_idx, line in enumerate(f):
+            if line_idx not in wanted_lines:
+                continue
+            data = json.loads(line)
+            for variant_idx, is_train in wanted_lines[line_idx]:
+                fn = fns[(variant_idx, is_train)]
+                out[(variant_idx, is_train, line_idx)] = fn(data) if is_train else fn(data, fp.stem)
+    return out
 
-    train = []
-    test = []
 
-    for d in tqdm.tqdm(paths_train):
-        pairs = train_processor(d)
-        train.extend((d, pair) for pair in pairs)
+class _Reservoir:
+    """Uniform sample of up to *k* items from a stream of unknown length (Algorithm R), deterministic for a seed."""
+
+    def __init__(self, k: int, seed: int):
+        self.k = k
+        self.rng = random.Random(seed)
+        self.items = []
+        self.n_seen = 0
+
+    def add(self, item):
+        self.n_seen += 1
+        if len(self.items) < self.k:
+            self.items.append(item)
+            return
+        idx = self.rng.randrange(self.n_seen)
+        if idx < self.k:
+            self.items[idx] = item
+
+    def sample(self) -> list:
+        """Returns the sampled items in a random (but seeded) order."""
+        items = self.items.copy()
+        self.rng.shuffle(items)
+        return items
 
-    for d in tqdm.tqdm(paths_test):
-        pairs = test_processor(d)
-        test.extend((d, pair) for pair in pairs)
 
-    # randomly sample desired number of train/test pairs from disjoint instances
-    # then write the rest to restf
-    train = sklearn.utils.shuffle(train, random_state=random_seed)
-    test = sklearn.utils.shuffle(test, random_state=random_seed)
-    train_samples = train[:desired_train_pairs]
-    test_samples = test[:desired_test_pairs]
-    n_discarded = len(train) - desired_train_pairs + len(test) - desired_test_pairs
+def _write_variant(variant: PrepVariant, train_samples, test_samples, n_discarded, token_counter):
+    """Writes the variant's files given the sampled (path, pair) lists."""
+    file_name = variant.file_name
+    desired_train_pairs = variant.desired_train_pairs
+    desired_test_pairs = variant.desired_test_pairs
 
     trainf = open(OUT_DIR / f"{file_name}-train-{desired_train_pairs}.jsonl", mode="w")
     train_insts = set()
-    train_chars = 0
     for inst, pair in train_samples:
         writeline(trainf, pair)
         train_insts.add(inst)
-        train_chars += len(pair["prompt"]) + len(pair["completion"])
     trainf.close()
 
-    if write_test_file:
+    if variant.write_test_file:
         testf = open(OUT_DIR / f"{file_name}-test-{desired_test_pairs}.jsonl", mode="w")
         test_insts = set()
         for inst, pair in test_samples:
@@ -220,78 +280,231 @@ def do_prep(
         f"{desired_test_pairs} testing pairs from {len(test_insts)} instances\n"
         f"{n_discarded} pairs discarded"
     )
-    train_tokens = train_chars / 4
-    davinci_ft_price = 0.03 / 1000
     print(
-        f"Estimated Davinci finetune cost ({train_epochs} epochs):"
-        f" ${train_tokens * davinci_ft_price * train_epochs:.2f}"
+        token_counts.pair_token_report(
+            f"{file_name}-train", (pair for _, pair in train_samples), token_counter, variant.train_epochs
+        )
     )
 
 
+def do_prep(paths, variants: list[PrepVariant], streaming=False):
+    """
+    Generates every variant's train/test files in a single sweep over the normalized data: each file is read once and
+    every variant that uses it is rendered from the same parsed data.
+
+    By default, every pair of every variant is rendered and held in memory before sampling, which selects the same pairs
+    as processing each variant on its own. If *streaming* is True, only the sampled pairs are ever held in memory or
+    rendered (see _do_prep_streaming).
+    """
+    random_seed = 42
+
+    # each variant gets the same split it would have gotten on its own; variants with the same proportion share one
+    splits = {}  # test_frac -> (paths_train, paths_test)
+    for variant in variants:
+        if variant.test_frac not in splits:
+            splits[variant.test_frac] = sklearn.model_selection.train_test_split(
+                paths, test_size=variant.test_frac, random_state=random_seed
+            )
+
+    token_counter = token_counts.TokenCounter()
+    if streaming:
+        _do_prep_streaming(paths, variants, splits, random_seed, token_counter)
+        return
+
+    # the work to do for each path: a list of distinct functions, and the index of each (variant, split)'s function
+    train_sets = {frac: set(paths_train) for frac, (paths_train, _) in splits.items()}
+    work = {}  # path -> (fns, {(variant idx, is_train): fn idx})
+    for fp in paths:
+        fns = []
+        fn_idxs = {}
+        for variant_idx, variant in enumerate(variants):
+            is_train = fp in train_sets[variant.test_frac]
+            fn = variant.train_fn if is_train else _TestFn(variant.test_fn)
+            # variants that share a processor (e.g. the sta-nar test processor) only run it once
+            if fn not in fns:
+                fns.append(fn)
+            fn_idxs[(variant_idx, is_train)] = fns.index(fn)
+        work[fp] = (fns, fn_idxs)
+
+    # render each file's prompts, in parallel if enabled (process_map returns results in input order)
+    start = time.perf_counter()
+    if RUN_PARALLEL:
+        file_results = tqdm.contrib.concurrent.process_map(
+            _prep_file_task, [(fp, work[fp][0]) for fp in paths], chunksize=10
+        )
+    else:
+        file_results = [_prep_file(fp, work[fp][0]) for fp in tqdm.tqdm(paths)]
+    elapsed = time.perf_counter() - start
+    n_rendered = sum(len(r) for fn_results in file_results for r in fn_results)
+    log.info(f"Rendered {n_rendered} results from {len(paths)} files in {elapsed:.1f}s ({n_rendered / elapsed:.1f}/s)")
+    results = {fp: (fn_results, work[fp][1]) for fp, fn_results in zip(paths, file_results)}
+
+    # gather the pairs for each variant in the order of its split, as if it had been processed on its own
+    for variant_idx, variant in enumerate(variants):
+        paths_train, paths_test = splits[variant.test_frac]
+        train = []
+        test = []
+        for d in paths_train:
+            fn_results, fn_idxs = results[d]
+            train.extend((d, pair) for pair in fn_results[fn_idxs[(variant_idx, True)]])
+        for d in paths_test:
+            fn_results, fn_idxs = results[d]
+            test.extend((d, pair) for pair in fn_results[fn_idxs[(variant_idx, False)]])
+
+        # randomly sample desired number of train/test pairs from disjoint instances
+        train = sklearn.utils.shuffle(train, random_state=random_seed)
+        test = sklearn.utils.shuffle(test, random_state=random_seed)
+        n_discarded = len(train) - variant.desired_train_pairs + len(test) - variant.desired_test_pairs
+        train_samples = train[: variant.desired_train_pairs]
+        test_samples = test[: variant.desired_test_pairs]
+        _write_variant(variant, train_samples, test_samples, n_discarded, token_counter)
+
+
+def _do_prep_streaming(paths, variants: list[PrepVariant], splits, random_seed, token_counter):
+    """
+    Two passes over the normalized data with memory bounded by the number of desired pairs:
+    1. reservoir-sample (path, line index) references to eligible data for each variant and split
+    2. re-read only the files with sampled data and render just the sampled lines
+    """
+    # pass 1: select
+    train_sets = {frac: set(paths_train) for frac, (paths_train, _) in splits.items()}
+    reservoirs = {}  # (variant idx, is_train) -> _Reservoir
+    for variant_idx, variant in enumerate(variants):
+        reservoirs[(variant_idx, True)] = _Reservoir(variant.desired_train_pairs, random_seed)
+        reservoirs[(variant_idx, False)] = _Reservoir(variant.desired_test_pairs, random_seed)
+
+    for fp in tqdm.tqdm(paths):
+        for line_idx, data in enumerate(read_jsonl_file(fp)):
+            for variant_idx, variant in enumerate(variants):
+                is_train = fp in train_sets[variant.test_frac]
+                if is_train:
+                    eligible = variant.train_eligible or (lambda d: bool(variant.train_fn(d)))
+                else:
+                    eligible = variant.test_eligible or (lambda d: bool(variant.test_fn(d, fp.stem)))
+                if eligible(data):
+                    reservoirs[(variant_idx, is_train)].add((fp, line_idx))
+
+    # pass 2: render
+    samples = {key: reservoir.sample() for key, reservoir in reservoirs.items()}
+    wanted = collections.defaultdict(lambda: collections.defaultdict(list))  # path -> line idx -> [(variant, split)]
+    for key, refs in samples.items():
+        for fp, line_idx in refs:
+            wanted[fp][line_idx].append(key)
+
+    # render the sampled lines of each file, in parallel if enabled
+    tasks = []
+    for fp in paths:
+        if fp not in wanted:
+            continue
+        wanted_lines = dict(wanted[fp])
+        keys = {key for line_keys in wanted_lines.values() for key in line_keys}
+        fns = {
+            (variant_idx, is_train): variants[variant_idx].train_fn if is_train else variants[variant_idx].test_fn
+            for variant_idx, is_train in keys
+        }
+        tasks.append((fp, wanted_lines, fns))
+    if RUN_PARALLEL:
+        file_results = tqdm.contrib.concurrent.process_map(_render_lines_task, tasks, chunksize=10)
+    else:
+        file_results = [_render_lines_task(task) for task in tqdm.tqdm(tasks)]
+    rendered = {}  # (variant idx, is_train, path, line idx) -> pair
+    for (fp, _, _), results in zip(tasks, file_results):
+        for (variant_idx, is_train, line_idx), pair in results.items():
+            rendered[(variant_idx, is_train, fp, line_idx)] = pair
+
+    for variant_idx, variant in enumerate(variants):
+        train_samples = []
+        test_samples = []
+        for is_train, out in ((True, train_samples), (False, test_samples)):
+            for fp, line_idx in samples[(variant_idx, is_train)]:
+                pair = rendered[(variant_idx, is_train, fp, line_idx)]
+                if not pair:
+                    log.warning(f"{variant.file_name}: {fp.stem}:{line_idx} was eligible but did not render")
+                    continue
+                out.append((fp, pair))
+        n_discarded = (
+            reservoirs[(variant_idx, True)].n_seen
+            - variant.desired_train_pairs
+            + reservoirs[(variant_idx, False)].n_seen
+            - variant.desired_test_pairs
+        )
+        _write_variant(variant, train_samples, test_samples, n_discarded, token_counter)
+
+
 # Ablations:
 # - remove state
 # - partial states
 # - few-shot
-def main(paths: list[pathlib.Path]):
-    do_prep(
-        paths,
-        process_utt_cmd_train,
-        process_utt_cmd_test,
+VARIANTS = [
+    PrepVariant(
         "ft-utt-cmd",
+        utt_cmd_train_pair,
+        utt_cmd_test_datum,
         desired_train_pairs=30000,
         desired_test_pairs=1000,
         train_epochs=1,
-    )
-    do_prep(
-        paths,
-        lambda fp: process_utt_cmd_train(fp, ablations=["actors", "current"]),
-        process_utt_cmd_test,
+        train_eligible=utt_cmd_eligible,
+        test_eligible=utt_cmd_eligible,
+    ),
+    PrepVariant(
         "ft-utt-cmd-ablations",
+        functools.partial(utt_cmd_train_pair, ablations=["actors", "current"]),
+        utt_cmd_test_datum,
         desired_train_pairs=30000,
         desired_test_pairs=1000,
         train_epochs=1,
         write_test_file=False,
-    )
-
-    do_prep(
-        paths,
-        process_sta_nar_train,
-        process_sta_nar_test,
+        train_eligible=utt_cmd_eligible,
+        test_eligible=utt_cmd_eligible,
+    ),
+    PrepVariant(
         "ft-sta-nar",
+        sta_nar_train_pair,
+        sta_nar_test_datum,
         desired_train_pairs=20000,
         desired_test_pairs=1000,
         train_epochs=1,
-    )
-    do_prep(
-        paths,
-        lambda fp: process_sta_nar_train(fp, ablations=["actors", "targets", "caster"]),
-        process_sta_nar_test,
+        train_eligible=sta_nar_train_eligible,
+        test_eligible=sta_nar_test_eligible,
+    ),
+    PrepVariant(
         "ft-sta-nar-ablations",
+        functools.partial(sta_nar_train_pair, ablations=["actors", "targets", "caster"]),
+        sta_nar_test_datum,
         desired_train_pairs=20000,
         desired_test_pairs=1000,
         train_epochs=1,
         write_test_file=False,
-    )
-    do_prep(
-        paths,
-        process_sta_nar_command_utterance_train,
-        process_sta_nar_test,
+        train_eligible=sta_nar_train_eligible,
+        test_eligible=sta_nar_test_eligible,
+    ),
+    PrepVariant(
         "ft-sta-nar-command-utterance",
+        sta_nar_command_utterance_train_pair,
+        sta_nar_test_datum,
         desired_train_pairs=20000,
         desired_test_pairs=1000,
         train_epochs=1,
         write_test_file=False,
-    )
-    do_prep(
-        paths,
-        process_sta_nar_dialog_continuation_train,
-        process_sta_nar_test,
+        train_eligible=sta_nar_train_eligible,
+        test_eligible=sta_nar_test_eligible,
+    ),
+    PrepVariant(
         "ft-sta-nar-dialog-continuation",
+        sta_nar_dialog_continuation_train_pair,
+        sta_nar_test_datum,
         desired_train_pairs=20000,
         desired_test_pairs=1000,
         train_epochs=1,
         write_test_file=False,
-    )
+        train_eligible=sta_nar_train_eligible,
+        test_eligible=sta_nar_test_eligible,
+    ),
+]
+
+
+def main(paths: list[pathlib.Path]):
+    do_prep(paths, VARIANTS, streaming=STREAMING)
 
 
 if __name__ == "__main__":
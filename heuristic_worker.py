@@ -1,15 +1,16 @@
 import argparse
-import csv
 import functools
 import logging
 import os
 import pathlib
 
+import numpy as np
 import tqdm
 import tqdm.contrib.concurrent
 import tqdm.contrib.logging
 
 import heuristics
+from dataset.result_store import ResultStore, heuristic_code_hash
 from dataset.utils import combat_dir_iterator, dataset_checksum, get_combat_dirs
 
 # ===== argparsing =====
@@ -39,6 +40,11 @@ parser.add_argument(
     help="forces the worker to recompute regardless of prior computation",
     action="store_true",
 )
+parser.add_argument(
+    "--import-csv",
+    help="imports results in the old format (one CSV per heuristic in the output dir) into the result store and exits",
+    action="store_true",
+)
 parser.add_argument("--help", help="displays CLI help", action="help")
 
 # ===== main =====
@@ -62,12 +68,15 @@ class Runner:
         result_dir_path: pathlib.Path,
         compute_heuristics: list[str] | None = None,
         force_recompute: bool = False,
+        import_csv: bool = False,
     ):
         self.data_dir_path = data_dir_path
         self.result_dir_path = result_dir_path
         self.heuristics = compute_heuristics
         self.force_recompute = force_recompute
+        self.import_csv = import_csv
         self.dataset_checksum = None
+        self.store = ResultStore(result_dir_path)
 
     @classmethod
     def from_args(cls, args: argparse.Namespace):
@@ -76,6 +85,7 @@ class Runner:
             result_dir_path=args.output_dir,
             compute_heuristics=args.heuristic,
             force_recompute=args.force_recompute,
+            import_csv=args.import_csv,
         )
 
     def init(self):
@@ -87,38 +97,40 @@ class Runner:
 
     def run_one(self, heuristic_name: str):
         log.info(f"Applying heuristic {heuristic_name!r}...")
-        result_file_path = self.result_dir_path / f"{heuristic_name}.csv"
         heuristic = get_heuristic(heuristic_name)
+        code_hash = heuristic_code_hash(heuristic)
         entrypoint = functools.partial(worker_entrypoint, heuristic)
 
-        # if the results already exist for this dataset and heuristic, we can skip everything
-        try:
-            with open(result_file_path, newline="") as f:
-                reader = csv.reader(f)
-                _, existing_checksum = next(reader)
+        # if the results already exist for this dataset and heuristic code, we can skip everything
+        existing = self.store.provenance().get(heuristic_name)
+        if existing is not None:
             if self.force_recompute:
-                log.info(
-                    f"A result for this dataset already exists at {os.path.relpath(result_file_path)} but recompute is"
-                    " forced, overwriting..."
-                )
-            elif existing_checksum == self.dataset_checksum:
-                log.info(f"A result for this dataset already exists at {os.path.relpath(result_file_path)}!")
-                return
-            else:
+                log.info("A result for this dataset already exists but recompute is forced, overwriting...")
+            elif existing["dataset_checksum"] != self.dataset_checksum:
                 log.info("An existing result was found but the checksum does not match, overwriting...")
-        except FileNotFoundError:
-            pass
+            elif existing["code_hash"] != code_hash:
+                log.info("An existing result was found but the heuristic's code has changed, overwriting...")
+            else:
+                log.info(f"A result for this dataset already exists in {os.path.relpath(self.store.path)}!")
+                return
 
         # execution
+        # results stay in dataset order (the same order Dataset lists instances in), so they load without a join
         results = tqdm.contrib.concurrent.process_map(entrypoint, get_combat_dirs(self.data_dir_path), chunksize=10)
-        results.sort(key=lambda pair: pair[1])
         log.info(f"Application of {heuristic_name} complete, saving results...")
 
         # save results
-        with open(result_file_path, "w", newline="") as f:
-            writer = csv.writer(f)
-            writer.writerow(("checksum", self.dataset_checksum))
-            writer.writerows(results)
+        instance_ids = [instance_id for instance_id, _ in results]
+        scores = np.array([score for _, score in results], dtype=np.float32)
+        self.store.upsert_column(heuristic_name, instance_ids, scores, code_hash, self.dataset_checksum)
+
+    def import_csv_results(self):
+        csv_paths = [path for path in self.result_dir_path.glob("*.csv") if path.stem in heuristics.__all__]
+        code_hashes = {path.stem: heuristic_code_hash(get_heuristic(path.stem)) for path in csv_paths}
+        # rows in dataset order, so the imported results load without a join
+        instance_ids = [instance_path.stem for instance_path in get_combat_dirs(self.data_dir_path)]
+        self.store.import_csv_results(csv_paths, code_hashes, instance_ids)
+        log.info(f"Imported {len(csv_paths)} results into {os.path.relpath(self.store.path)}")
 
     def run_heuristics(self, heuristic_names: list[str]):
         if not all(hasattr(heuristics, name) for name in heuristic_names):
@@ -134,6 +146,9 @@ class Runner:
         self.run_heuristics(heuristics.__all__)
 
     def run_cli(self):
+        if self.import_csv:
+            self.import_csv_results()
+            return
         self.init()
 
         if self.heuristics is None:
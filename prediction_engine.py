@@ -0,0 +1,295 @@
+"""
+Async engine for getting completions for every datum in a test set (used by the *_test_predictions.py scripts and
+fewshot_predict.py).
+
+Each script defines one PredictionTask per model/variant and calls run_cli(tasks). Requests run concurrently, are
+paced by a shared request/token rate limiter, and are retried with exponential backoff on transient errors. Results
+are appended to the result file as they complete, so an interrupted run resumes where it left off. Completions are
+also stored in a local cache (see completion_cache.py) that is prefetched in bulk, so a re-run only requests the
+prompts it has not seen before.
+
+To test against a local stub server instead of the OpenAI API, pass --api-base (e.g. http://127.0.0.1:8000/v1).
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import pathlib
+import random
+import time
+from typing import Callable, NamedTuple
+
+import openai
+import tqdm
+import tqdm.contrib.logging
+
+import prompts
+from completion_cache import COMPLETION_CACHE_PATH, CompletionCache, completion_key
+from dataset.utils import read_jsonl_file
+
+log = logging.getLogger("predictions")
+logging.getLogger("openai").setLevel(logging.WARNING)
+
+OPENAI_API_BASE = "https://api.openai.com/v1"
+RETRYABLE_ERRORS = (
+    openai.error.APIConnectionError,
+    openai.error.APIError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+)
+
+
+class PredictionTask(NamedTuple):
+    """
+    A set of predictions to make for a test set. *prompters* maps each result key (e.g. "prediction_full") to a
+    function that returns the prompt for a datum (or None to skip the datum); each key is filled with one completion.
+    """
+
+    test_data_file: pathlib.Path
+    result_file: pathlib.Path
+    model: str
+    prompters: dict[str, Callable[[dict], str | None]]
+    temperature: float
+    max_tokens: int = 256
+    stop: tuple[str, ...] = ("\n<|aeot|>",)
+    strip: bool = True
+
+    @property
+    def completion_params(self) -> dict:
+        return dict(
+            model=self.model,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            top_p=1,
+            frequency_penalty=0,
+            presence_penalty=0,
+            stop=list(self.stop),
+        )
+
+
+def datum_key(datum: dict) -> str:
+    """Returns a stable key identifying a test datum (used to match results to test data when resuming)."""
+    return hashlib.sha1(json.dumps(datum, sort_keys=True).encode()).hexdigest()
+
+
+class RateLimiter:
+    """Async token bucket limiting both requests per minute and (estimated) tokens per minute."""
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        self.request_rate = requests_per_minute / 60
+        self.token_rate = tokens_per_minute / 60
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        # start at 1/10 capacity so that a burst on startup does not immediately trip the API's own limiter
+        self.requests = self.request_capacity / 10
+        self.tokens = self.token_capacity / 10
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.requests = min(self.request_capacity, self.requests + elapsed * self.request_rate)
+        self.tokens = min(self.token_capacity, self.tokens + elapsed * self.token_rate)
+
+    async def acquire(self, n_tokens: int):
+        n_tokens = min(n_tokens, self.token_capacity)
+        # holding the lock while waiting keeps requests first-come first-served
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.requests >= 1 and self.tokens >= n_tokens:
+                    self.requests -= 1
+                    self.tokens -= n_tokens
+                    return
+                wait = max((1 - self.requests) / self.request_rate, (n_tokens - self.tokens) / self.token_rate)
+                await asyncio.sleep(wait)
+
+
+class PredictionEngine:
+    def __init__(
+        self,
+        task: PredictionTask,
+        concurrency: int = 8,
+        requests_per_minute: int = 3000,
+        tokens_per_minute: int = 250000,
+        max_retries: int = 6,
+        api_base: str | None = None,
+        cache: CompletionCache | None = None,
+    ):
+        self.task = task
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.max_retries = max_retries
+        self.api_base = api_base
+        # the endpoint requests actually go to (the OPENAI_API_BASE env var also redirects them), for cache keys
+        endpoint = (api_base or openai.api_base).rstrip("/")
+        self.cache_endpoint = None if endpoint == OPENAI_API_BASE else endpoint
+        self.cache = cache
+        self.cached_completions = {}
+        # stats
+        self.n_completed = 0
+        self.n_skipped = 0
+        self.n_failed = 0
+
+    async def complete(self, prompt: str) -> str:
+        """Returns the completion of a prompt, from the cache if possible."""
+        key = completion_key(prompt, self.task.completion_params, self.cache_endpoint)
+        if key in self.cached_completions:
+            if self.cache is not None:
+                self.cache.hits += 1
+            text = self.cached_completions[key]
+        else:
+            if self.cache is not None:
+                self.cache.misses += 1
+            text = await self.request_completion(prompt)
+            self.cached_completions[key] = text
+            if self.cache is not None:
+                self.cache.put(key, self.task.model, text)
+        return text.strip() if self.task.strip else text
+
+    async def request_completion(self, prompt: str) -> str:
+        """Requests a completion of a prompt from the API, retrying transient errors with exponential backoff."""
+        await self.rate_limiter.acquire(prompts.estimate_tokens(prompt) + self.task.max_tokens)
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await openai.Completion.acreate(
+                    prompt=prompt, api_base=self.api_base, **self.task.completion_params
+                )
+                break
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(60, 2**attempt) * random.uniform(0.5, 1.5)
+                log.warning(f"{type(e).__name__}: {e} (retrying in {delay:.1f}s)")
+                await asyncio.sleep(delay)
+                await self.rate_limiter.acquire(prompts.estimate_tokens(prompt) + self.task.max_tokens)
+        return response["choices"][0]["text"]
+
+    def prompts_for(self, datum: dict) -> list[str] | None:
+        """Returns the prompt for each of the task's prediction keys, or None if the datum should be skipped."""
+        prompt_strs = [prompter(datum) for prompter in self.task.prompters.values()]
+        if not all(prompt_strs):
+            return None
+        return prompt_strs
+
+    async def predict_datum(self, datum: dict, prompt_strs: list[str]) -> dict:
+        """Returns the datum with all of the task's predictions added."""
+        predictions = await asyncio.gather(*(self.complete(prompt) for prompt in prompt_strs))
+        return {**datum, **dict(zip(self.task.prompters, predictions))}
+
+    def prefetch(self, prompt_strs: list[str]):
+        """Loads any cached completions of the given prompts, so that only the misses are dispatched to the API."""
+        if self.cache is None:
+            return
+        params = self.task.completion_params
+        self.cached_completions.update(
+            self.cache.prefetch([completion_key(prompt, params, self.cache_endpoint) for prompt in prompt_strs])
+        )
+
+    def load_completed(self) -> set[str]:
+        """Returns the keys of the test data that already have results in the result file."""
+        completed = set()
+        if not self.task.result_file.is_file():
+            return completed
+        with open(self.task.result_file) as f:
+            for line in f:
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:  # a crash mid-write can truncate the last line
+                    continue
+                for key in self.task.prompters:
+                    result.pop(key, None)
+                completed.add(datum_key(result))
+        return completed
+
+    async def run(self):
+        completed = self.load_completed()
+        todo = [d for d in read_jsonl_file(self.task.test_data_file) if datum_key(d) not in completed]
+        log.info(f"{len(completed)} results already in {self.task.result_file}, {len(todo)} remaining")
+
+        prompted = []
+        for datum in todo:
+            prompt_strs = self.prompts_for(datum)
+            if prompt_strs is None:
+                self.n_skipped += 1
+            else:
+                prompted.append((datum, prompt_strs))
+        self.prefetch([prompt for _, prompt_strs in prompted for prompt in prompt_strs])
+        if self.cache is not None:
+            log.info(f"{len(self.cached_completions)} completions found in the cache")
+
+        queue = asyncio.Queue()
+        for item in prompted:
+            queue.put_nowait(item)
+        start = time.perf_counter()
+
+        with open(self.task.result_file, "a") as out, tqdm.tqdm(total=len(prompted)) as progress:
+
+            async def worker():
+                while not queue.empty():
+                    datum, prompt_strs = queue.get_nowait()
+                    try:
+                        result = await self.predict_datum(datum, prompt_strs)
+                    except openai.error.InvalidRequestError:
+                        log.exception("Failed to get prediction:")
+                        self.n_failed += 1
+                    else:
+                        out.write(json.dumps(result))
+                        out.write("\n")
+                        out.flush()
+                        self.n_completed += 1
+                    progress.update()
+
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+        elapsed = time.perf_counter() - start
+        print(
+            f"Predictions complete in {elapsed:.1f}s!\n"
+            f"Completed: {self.n_completed} (+{len(completed)} from a previous run)\n"
+            f"Skipped (no prompt): {self.n_skipped}\n"
+            f"Failed: {self.n_failed}"
+        )
+        if self.cache is not None:
+            print(
+                f"Completion cache: {self.cache.hits} hits, {self.cache.misses} misses"
+                f" ({self.cache.hit_rate:.1%} hit rate)"
+            )
+
+
+def run_cli(tasks: dict[str, PredictionTask], description: str):
+    """Parses the CLI arguments, then runs the chosen task."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("task", choices=list(tasks), help="the model/variant to get predictions for")
+    parser.add_argument("-c", "--concurrency", help="the number of concurrent requests", default=8, type=int)
+    parser.add_argument("--rpm", help="the maximum requests per minute", default=3000, type=int)
+    parser.add_argument("--tpm", help="the maximum (estimated) tokens per minute", default=250000, type=int)
+    parser.add_argument("--api-base", help="the API base URL (e.g. of a local stub server)")
+    parser.add_argument("--cache", help="the completion cache DB", default=COMPLETION_CACHE_PATH, type=pathlib.Path)
+    parser.add_argument("--no-cache", help="always request new completions", action="store_true")
+    parser.add_argument(
+        "--restart", help="back up any existing result file and start over instead of resuming", action="store_true"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
+
+    task = tasks[args.task]
+    if args.restart and task.result_file.is_file():
+        now = int(time.time())
+        task.result_file.rename(task.result_file.with_stem(f"{task.result_file.stem}-backup-{now}"))
+
+    engine = PredictionEngine(
+        task,
+        concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        api_base=args.api_base,
+        cache=None if args.no_cache else CompletionCache(args.cache),
+    )
+    with tqdm.contrib.logging.logging_redirect_tqdm():
+        asyncio.run(engine.run())
+    if engine.cache is not None:
+        engine.cache.close()
@@ -1,9 +1,58 @@
+import functools
+import re
+
 SEP = "\n<|asep|>\n"
 COMMAND_SEP = "\n<|csep|>\n"
 STOP_SEQ = "\n<|aeot|>"
 
+# approximation of the GPT-2/3 BPE pre-tokenization regex (python's re has no \p{L}/\p{N} classes)
+_PRETOKEN_RE = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+| ?[^\s\w]+|\s+(?!\S)|\s+""")
+
+
+# ===== token estimates =====
+@functools.lru_cache(maxsize=65536)
+def estimate_line_tokens(line: str) -> int:
+    """
+    Returns a fast estimate of the number of GPT-3 tokens in a single line of text. Each pre-token is assumed to cost
+    one token per 4 characters, which slightly overestimates (i.e. errs on the side of fitting in the context).
+    """
+    return sum(max(1, (len(piece) + 3) // 4) for piece in _PRETOKEN_RE.findall(line))
+
+
+def estimate_tokens(text: str) -> int:
+    """Returns a fast estimate of the number of GPT-3 tokens in a text. Lines are estimated (and cached) separately."""
+    lines = text.split("\n")
+    return sum(estimate_line_tokens(line) for line in lines) + len(lines) - 1
+
+
+# ===== actors =====
+# the parts of a normalized actor (see Distill4Inst.normalize_actor) that are rendered into prompts
+_ACTOR_RENDER_KEYS = ("name", "race", "class", "hp", "effects", "description", "attacks", "spells", "actions")
+
+
+def actor_key(actor: dict) -> tuple:
+    """Returns a stable, hashable key of the rendered parts of a normalized actor (all of which are str or None)."""
+    return tuple(actor[k] for k in _ACTOR_RENDER_KEYS)
+
 
 def stringify_actor(actor: dict):
+    """
+    Returns the short, long, and description strings for a normalized actor.
+    The same actor (e.g. the same monster at the same HP) recurs across many prompts, so renders are memoized by
+    actor_key - the returned dict is shared and must not be mutated.
+    """
+    return _stringify_actor_by_key(actor_key(actor))
+
+
+def actor_render_cache_info():
+    """Returns the hit/miss statistics of the stringify_actor cache."""
+    return _stringify_actor_by_key.cache_info()
+
+
+@functools.lru_cache(maxsize=16384)
+def _stringify_actor_by_key(key: tuple) -> dict:
+    actor = dict(zip(_ACTOR_RENDER_KEYS, key))
+
     # Name (Race/creature type; class if available) <X/Y HP> [Effects]
     short_parts = [actor["name"]]
     race_and_class_parts = []
@@ -52,7 +101,8 @@ def stringify_actor(actor: dict):
 
 # parts for ablation: actors, current actor, and their constituent parts
 # possible ablations = ["actors","current"]
-def utt_cmd_prompt(data, include_sep=True, ablations=[]) -> str | None:
+# if max_tokens is given, the prompt is shortened until its estimated length fits (see estimate_tokens)
+def utt_cmd_prompt(data, include_sep=True, ablations=[], max_tokens=None) -> str | None:
     before = data["before_utterances"]
     state_before = data["combat_state_before"]
     current = data["current_actor"]
@@ -81,21 +131,41 @@ def utt_cmd_prompt(data, include_sep=True, ablations=[]) -> str | None:
     # completion:
     # command
     # <|aeot|>
-    prompt_parts = []
-    actors = [f"- {stringify_actor(a)['short']}" for a in state_before]
-    actors_prompt = f"Actors:\n" + "\n".join(actors)
-    if actors and "actors" not in ablations:
-        prompt_parts.append(actors_prompt)
-    if "current" not in ablations:
-        if current is not None:
-            prompt_parts.append(f"Current:\n{stringify_actor(current)['long']}")
-        else:
-            prompt_parts.append("Current:\nNone")
+    actors = [f"- {stringify_actor(a)['short']}" for a in state_before] if "actors" not in ablations else []
+    current_strs = stringify_actor(current) if current is not None and "current" not in ablations else None
+    current_str = current_strs["long"] if current_strs is not None else "None"
+    rp_lines = list(before)
+
+    def build():
+        prompt_parts = []
+        actors_prompt = f"Actors:\n" + "\n".join(actors)
+        if actors:
+            prompt_parts.append(actors_prompt)
+        if "current" not in ablations:
+            prompt_parts.append(f"Current:\n{current_str}")
+
+        rp = "\n".join(rp_lines)
+        prompt_parts.append(rp)
 
-    rp = "\n".join(before)
-    prompt_parts.append(rp)
+        return "\n\n".join(prompt_parts) + (SEP if include_sep else "")
 
-    return "\n\n".join(prompt_parts) + (SEP if include_sep else "")
+    prompt = build()
+    if max_tokens is None:
+        return prompt
+
+    # drop or shorten the lowest-priority parts until the prompt fits:
+    # other actors (from the end of the list) -> current actor details -> oldest utterances
+    while estimate_tokens(prompt) > max_tokens:
+        if actors:
+            actors.pop()
+        elif current_strs is not None and current_str != current_strs["short"]:
+            current_str = current_strs["short"]
+        elif len(rp_lines) > 1:
+            rp_lines.pop(0)
+        else:
+            break
+        prompt = build()
+    return prompt
 
 
 def utt_cmd_completion(data, include_sep=True, command_sep=COMMAND_SEP) -> str | None:
@@ -104,7 +174,8 @@ def utt_cmd_completion(data, include_sep=True, command_sep=COMMAND_SEP) -> str |
 
 
 # ablations: actors, targets, caster, history
-def sta_nar_prompt(data, include_sep=True, ablations=[]) -> str | None:
+# if max_tokens is given, the prompt is shortened until its estimated length fits (see estimate_tokens)
+def sta_nar_prompt(data, include_sep=True, ablations=[], max_tokens=None) -> str | None:
     state_after = data["combat_state_after"]
     caster = data["caster_after"]
     targets = data["targets_after"]
@@ -142,31 +213,55 @@ def sta_nar_prompt(data, include_sep=True, ablations=[]) -> str | None:
     # after
     # <|aeot|>
 
-    prompt_parts = []
-    if "history" not in ablations:
-        actors_prompt = f"History:\n" + "\n".join(utterance_history) + "\n---"
-        if utterance_history:
-            prompt_parts.append(actors_prompt)
+    history_lines = list(utterance_history) if "history" not in ablations else []
+    actors = [f"- {stringify_actor(a)['short']}" for a in state_after] if "actors" not in ablations else []
+    targets_str = [f"- {stringify_actor(a)['short']}" for a in targets] if "targets" not in ablations else []
+    caster_strs = stringify_actor(caster) if "caster" not in ablations else None
+    caster_description = caster_strs["description"] if caster_strs is not None else ""
+    caster_str = caster_strs["long"] if caster_strs is not None else ""
+
+    def build():
+        prompt_parts = []
+        history_prompt = f"History:\n" + "\n".join(history_lines) + "\n---"
+        if history_lines:
+            prompt_parts.append(history_prompt)
 
-    if "actors" not in ablations:
-        actors = [f"- {stringify_actor(a)['short']}" for a in state_after]
         actors_prompt = f"Actors:\n" + "\n".join(actors)
         if actors:
             prompt_parts.append(actors_prompt)
 
-    if "targets" not in ablations:
-        targets_str = [f"- {stringify_actor(a)['short']}" for a in targets]
         targets_prompt = f"Targets:\n" + "\n".join(targets_str)
-        if targets:
+        if targets_str:
             prompt_parts.append(targets_prompt)
 
-    if "caster" not in ablations:
-        caster_strs = stringify_actor(caster)
-        prompt_parts.append(f"{caster_strs['description']}{caster_strs['long']}")
+        if caster_strs is not None:
+            prompt_parts.append(f"{caster_description}{caster_str}")
+
+        prompt_parts.append("\n".join(automation_results))
 
-    prompt_parts.append("\n".join(automation_results))
+        return "\n\n".join(prompt_parts) + (SEP if include_sep else "")
 
-    return "\n\n".join(prompt_parts) + (SEP if include_sep else "")
+    prompt = build()
+    if max_tokens is None:
+        return prompt
+
+    # drop or shorten the lowest-priority parts until the prompt fits:
+    # actors (from the end of the list) -> caster description -> oldest history -> extra targets -> caster details
+    while estimate_tokens(prompt) > max_tokens:
+        if actors:
+            actors.pop()
+        elif caster_description:
+            caster_description = ""
+        elif history_lines:
+            history_lines.pop(0)
+        elif len(targets_str) > 1:
+            targets_str.pop()
+        elif caster_strs is not None and caster_str != caster_strs["short"]:
+            caster_str = caster_strs["short"]
+        else:
+            break
+        prompt = build()
+    return prompt
 
 
 def sta_nar_command_utterance_prompt(data, include_sep=True) -> str | None:
@@ -3,18 +3,25 @@
 a csv file with labels and one with heuristic features"""
 import argparse
 import pandas as pd
+import pyarrow.feather
 # import sklearn
 parser = argparse.ArgumentParser(description="create a dataset of instances for regression from \
     a csv file with labels and one with heuristic features")
 parser.add_argument("labels", help="csv file with labels")
-parser.add_argument("features", help="csv file with heuristic features (from explorer server)")
+parser.add_argument("features", help="csv file with heuristic features (from explorer server) \
+    or the heuristic result store (heuristic_results/heuristics.arrow)")
 parser.add_argument("output", help="output file")
 args = parser.parse_args()
 
 def main(args):
     """main function"""
     labels = pd.read_csv(args.labels, header=0, index_col=0)
-    features = pd.read_csv(args.features, header=0, index_col=0)
+    if args.features.endswith(".arrow"):
+        # the heuristic worker's result store, memory-mapped
+        features = pyarrow.feather.read_table(args.features, memory_map=True).to_pandas(split_blocks=True)
+        features = features.set_index("instance_id")
+    else:
+        features = pd.read_csv(args.features, header=0, index_col=0)
     print(labels.head(10), features.head(10))
     dataset = features.join(labels, how="inner", on="instance_id")
     dataset["RP to CMD"].fillna(-1,inplace=True)
@@ -1,11 +1,13 @@
 """
 Depends on *_test_predictions.py
 """
+import hashlib
 import json
 import pathlib
 import sys
 
 import tqdm
+import tqdm.contrib.concurrent
 
 sys.path.append("..")
 
@@ -14,6 +16,7 @@ from dataset.utils import combat_dir_iterator, read_jsonl_file
 from distill4_normalize import Distill4Inst
 
 DATA_DIR = pathlib.Path("../data/")
+RUN_PARALLEL = True
 
 # utt->cmd
 UTT_CMD_CANONICAL = pathlib.Path("../extract/ft-utt-cmd-test-1000.jsonl")
@@ -58,44 +61,124 @@ STA_NAR_KEYS = (
 HUMAN_EVAL_DATA = pathlib.Path("../human_eval/human-eval-sta-nar.jsonl")
 
 
+# ===== JOINING =====
+def canonical_key(datum: dict, keys: tuple[str, ...]) -> bytes:
+    """Returns a stable digest of the datum's values for *keys* (equal iff all of those values are deeply equal)."""
+    projection = json.dumps([datum[k] for k in keys], sort_keys=True)
+    return hashlib.blake2b(projection.encode(), digest_size=16).digest()
+
+
+def index_canonical(test_data: list[dict], keys: tuple[str, ...]) -> dict[bytes, dict]:
+    """Returns a map of canonical key -> test datum. If two test data share a key, the first wins."""
+    index = {}
+    n_duplicate = 0
+    for datum in test_data:
+        key = canonical_key(datum, keys)
+        if key in index:
+            n_duplicate += 1
+            continue
+        index[key] = datum
+    if n_duplicate:
+        print(f"WARNING: {n_duplicate} test data have the same key as an earlier datum and will never be matched")
+    return index
+
+
+def merge_predictions(
+    index: dict[bytes, dict], prediction_file: pathlib.Path, keys: tuple[str, ...], fields: dict[str, str]
+):
+    """
+    Copies each field (predicted name -> merged name) of every datum in *prediction_file* onto its canonical datum,
+    in one pass over the file. Raises if any predicted datum has no canonical datum.
+    """
+    n_merged = 0
+    n_unmatched = 0
+    seen = set()
+    n_duplicate = 0
+    for predicted_datum in read_jsonl_file(prediction_file):
+        key = canonical_key(predicted_datum, keys)
+        canonical_datum = index.get(key)
+        if canonical_datum is None:
+            n_unmatched += 1
+            continue
+        if key in seen:
+            n_duplicate += 1
+        seen.add(key)
+        for predicted_name, merged_name in fields.items():
+            canonical_datum[merged_name] = predicted_datum[predicted_name]
+        n_merged += 1
+
+    print(f"{prediction_file}: merged {n_merged}, unmatched {n_unmatched}, duplicate {n_duplicate} (last one wins)")
+    if n_unmatched:
+        raise RuntimeError(
+            f"couldn't find canonical for {n_unmatched} predictions in {prediction_file}, do you have the right version"
+            " of the test data?"
+        )
+
+
 # ===== COMMAND PREDICTION =====
+def utt_cmd_enrich_instance(group: tuple[str, list[int]]) -> list[tuple[dict, list[dict]]]:
+    """
+    Given an instance ID and a list of state event indexes in it, load the instance once and return the
+    (combat state, characters) at each index for pass@K testing.
+    """
+    instance_id, state_idxs = group
+    event_stream = combat_dir_iterator(DATA_DIR / instance_id)
+    inst = Distill4Inst(event_stream)
+    out = []
+    for state_idx in state_idxs:
+        # each datum only sees the characters around its own state
+        inst.characters = {}
+        combat_state = inst.events[state_idx]["data"]
+        inst.extract_characters_backward(inst.events[state_idx])
+        inst.extract_characters_forward(inst.events[state_idx])
+        characters = [c.to_dict() for c in inst.characters.values()]
+        out.append((combat_state, characters))
+    return out
+
+
 def merge_utt_cmd():
     test_data = list(read_jsonl_file(UTT_CMD_CANONICAL))
-
-    def find_canonical_datum_for(predicted_datum):
-        for datum in test_data:
-            if all(datum[k] == predicted_datum[k] for k in UTT_CMD_KEYS):
-                return datum
-        raise RuntimeError("couldn't find canonical, do you have the right version of ft-utt-cmd-test-1000.jsonl?")
+    index = index_canonical(test_data, UTT_CMD_KEYS)
 
     # merge the predictions
-    for predicted_datum in read_jsonl_file(UTT_CMD_FULL):
-        canonical_datum = find_canonical_datum_for(predicted_datum)
-        canonical_datum["prediction_full"] = predicted_datum["prediction_full"]
-
-    for predicted_datum in read_jsonl_file(UTT_CMD_NOSTATE):
-        canonical_datum = find_canonical_datum_for(predicted_datum)
-        canonical_datum["prediction_nostate"] = predicted_datum["prediction_nostate"]
-
-    for predicted_datum in read_jsonl_file(UTT_CMD_FEWSHOT):
-        canonical_datum = find_canonical_datum_for(predicted_datum)
-        canonical_datum["prediction_fewshot_full"] = predicted_datum["prediction_full"]
-        canonical_datum["prediction_fewshot_nostate"] = predicted_datum["prediction_nostate"]
+    merge_predictions(index, UTT_CMD_FULL, UTT_CMD_KEYS, {"prediction_full": "prediction_full"})
+    merge_predictions(index, UTT_CMD_NOSTATE, UTT_CMD_KEYS, {"prediction_nostate": "prediction_nostate"})
+    merge_predictions(
+        index,
+        UTT_CMD_FEWSHOT,
+        UTT_CMD_KEYS,
+        {"prediction_full": "prediction_fewshot_full", "prediction_nostate": "prediction_fewshot_nostate"},
+    )
 
     # generate the gold label, skipping any instances that don't have all the expected keys
     # also go back to the data and find the combat state and characters for pass@K testing
-    final_merged = []
     keys = ("prediction_full", "prediction_nostate", "prediction_fewshot_full", "prediction_fewshot_nostate")
-    for d in tqdm.tqdm(test_data):
+    complete_data = []
+    for d in test_data:
         if not all(k in d for k in keys):
             print("missing some predictions, skipping")
             continue
-        event_stream = combat_dir_iterator(DATA_DIR / d["instance_id"])
-        inst = Distill4Inst(event_stream)
-        combat_state = inst.events[d["before_state_idx"]]["data"]
-        inst.extract_characters_backward(inst.events[d["before_state_idx"]])
-        inst.extract_characters_forward(inst.events[d["before_state_idx"]])
-        characters = [c.to_dict() for c in inst.characters.values()]
+        complete_data.append(d)
+
+    # group the data by instance so each instance is only loaded once
+    positions_by_instance = {}
+    for pos, d in enumerate(complete_data):
+        positions_by_instance.setdefault(d["instance_id"], []).append(pos)
+    groups = [
+        (instance_id, [complete_data[pos]["before_state_idx"] for pos in positions])
+        for instance_id, positions in positions_by_instance.items()
+    ]
+    if RUN_PARALLEL:
+        group_results = tqdm.contrib.concurrent.process_map(utt_cmd_enrich_instance, groups)
+    else:
+        group_results = [utt_cmd_enrich_instance(group) for group in tqdm.tqdm(groups)]
+    enrichments = [None] * len(complete_data)
+    for positions, results in zip(positions_by_instance.values(), group_results):
+        for pos, result in zip(positions, results):
+            enrichments[pos] = result
+
+    final_merged = []
+    for d, (combat_state, characters) in zip(complete_data, enrichments):
         out = {
             "gold": prompts.utt_cmd_completion(d, include_sep=False),
             **{k: d[k] for k in keys},
@@ -114,29 +197,23 @@ def merge_utt_cmd():
 # ===== STATE -> NARRATION =====
 def merge_sta_nar():
     test_data = list(read_jsonl_file(STA_NAR_CANONICAL))
-
-    def find_canonical_datum_for(predicted_datum):
-        for datum in test_data:
-            if all(datum[k] == predicted_datum[k] for k in STA_NAR_KEYS):
-                return datum
-        raise RuntimeError("couldn't find canonical, do you have the right version of ft-sta-nar-test-1000.jsonl?")
+    index = index_canonical(test_data, STA_NAR_KEYS)
 
     # merge the predictions
-    for predicted_datum in read_jsonl_file(STA_NAR_FULL):
-        canonical_datum = find_canonical_datum_for(predicted_datum)
-        canonical_datum["prediction_full"] = predicted_datum["prediction_full"]
-
-    for predicted_datum in read_jsonl_file(STA_NAR_NOSTATE):
-        canonical_datum = find_canonical_datum_for(predicted_datum)
-        canonical_datum["prediction_nostate"] = predicted_datum["prediction_state-ablation"]
-
-    for predicted_datum in read_jsonl_file(STA_NAR_COMMAND_UTTERANCE):
-        canonical_datum = find_canonical_datum_for(predicted_datum)
-        canonical_datum["prediction_command_utterance"] = predicted_datum["prediction_command-utterance"]
-
-    for predicted_datum in read_jsonl_file(STA_NAR_DIALOG_CONTINUATION):
-        canonical_datum = find_canonical_datum_for(predicted_datum)
-        canonical_datum["prediction_dialog_continuation"] = predicted_datum["prediction_dialog-continuation"]
+    merge_predictions(index, STA_NAR_FULL, STA_NAR_KEYS, {"prediction_full": "prediction_full"})
+    merge_predictions(index, STA_NAR_NOSTATE, STA_NAR_KEYS, {"prediction_state-ablation": "prediction_nostate"})
+    merge_predictions(
+        index,
+        STA_NAR_COMMAND_UTTERANCE,
+        STA_NAR_KEYS,
+        {"prediction_command-utterance": "prediction_command_utterance"},
+    )
+    merge_predictions(
+        index,
+        STA_NAR_DIALOG_CONTINUATION,
+        STA_NAR_KEYS,
+        {"prediction_dialog-continuation": "prediction_dialog_continuation"},
+    )
 
     # generate the gold label, skipping any instances that don't have all the expected keys
     final_merged = []
@@ -1,10 +1,21 @@
-"""Given a dataset instance, replace all IDs with md5(id) and usernames with "Player #"."""
+"""
+Given a dataset instance, replace all IDs with md5(id) and usernames with "Player #".
+
+With CORPUS_IDENTITY_MAP, a first pass over the message events of every instance assigns each author one "Player #"
+for the whole corpus, so the same user has the same pseudonym in every instance. The map is saved to
+IDENTITY_MAP_PATH - it links real IDs to pseudonyms, so do not release it with the anonymized data! Authors missing
+from the map (i.e. if it is stale) get "Unmapped #" names, numbered per instance, so they never share a "Player #" with
+another author.
+"""
+import functools
 import hashlib
+import json
 import logging
 import os
 import pathlib
 import re
 import sys
+from typing import Callable, Iterable
 
 import tqdm.contrib.concurrent
 import tqdm.contrib.logging
@@ -16,11 +27,17 @@ from dataset import utils
 DATA_DIR = pathlib.Path(os.path.dirname(__file__), "../data")
 EXP4_DIR = pathlib.Path(os.path.dirname(__file__), "../extract/experiment4")
 OUT_DIR = pathlib.Path(os.path.dirname(__file__), "../anonymized")
+IDENTITY_MAP_PATH = pathlib.Path(os.path.dirname(__file__), "../extract/anonymize_identity_map.json")
 
 RUN_PARALLEL = True
+# read each instance twice (once to collect names/IDs, once to rewrite) instead of holding it all in memory
+STREAMING = True
+# give each author the same pseudonym in every instance (otherwise, authors are numbered per instance)
+CORPUS_IDENTITY_MAP = True
 log = logging.getLogger("anonymize")
 
 
+@functools.lru_cache(maxsize=65536)
 def hash_id(user_id: int | str) -> str:
     """Deterministic 1-way method of transforming Discord snowflakes into other numbers"""
     user_id = str(user_id).encode()
@@ -29,11 +46,114 @@ def hash_id(user_id: int | str) -> str:
     return "{0:0>18}".format(str(int.from_bytes(md5.digest(), "little", signed=False))[:18])
 
 
+def clean_message_content(content: str) -> str:
+    """Removes role/channel mentions, hashes user mentions, and replaces custom emoji with their names."""
+    # remove role, channel mentions
+    content = re.sub(r"<@&\d{17,20}>", "<@&role>", content)
+    content = re.sub(r"<#\d{17,20}>", "<#channel>", content)
+
+    # replace user mentions with hash
+    content = re.sub(r"<@!?(\d{17,20})>", lambda m: f"<@{hash_id(m[1])}>", content)
+
+    # replace custom emoji with just their name
+    content = re.sub(r"<a?(:\w+?:)\d{17,20}>", r"\1", content)
+    return content
+
+
+def message_event_iterator(dirpath: utils.AnyPath) -> Iterable[dict]:
+    """
+    Given a path to a combat dir, return an iterator of only its message events. Other events are skipped without
+    being parsed unless they contain the string "message".
+    """
+    for event_bytes in utils.combat_dir_iterator_raw(dirpath):
+        if b'"message"' not in event_bytes:
+            continue
+        event = json.loads(event_bytes)
+        if event["event_type"] == "message":
+            yield event
+
+
+def build_replacer(replacements: dict[str, str]) -> Callable[[str], str] | None:
+    """
+    Returns a function that makes every replacement in a string in one pass (or None if there is nothing to replace).
+    Keys are matched longest-first, so a name that contains another name is replaced as a whole.
+    """
+    # an empty key would match between every character
+    keys = sorted((k for k in replacements if k), key=len, reverse=True)
+    if not keys:
+        return None
+    pattern = re.compile("|".join(map(re.escape, keys)))
+    return functools.partial(pattern.sub, lambda m: replacements[m[0]])
+
+
+# ===== corpus identity map =====
+def collect_instance_authors(instance_path: pathlib.Path) -> list[str]:
+    """Map step: returns the IDs of the (non-Avrae) message authors in an instance, in order of first appearance."""
+    authors = {}
+    for msg in message_event_iterator(instance_path):
+        if msg["author_id"] != AVRAE_ID:
+            authors.setdefault(str(msg["author_id"]), None)
+    return list(authors)
+
+
+def build_identity_map(dirs: list[pathlib.Path]) -> dict[str, dict]:
+    """
+    Returns a map of author ID -> {"name": pseudonym, "hash": hashed ID} over all of the instances, numbering authors
+    in order of first appearance (in the order *dirs* are given, so the numbering is deterministic).
+    """
+    if RUN_PARALLEL:
+        authors_by_instance = tqdm.contrib.concurrent.process_map(collect_instance_authors, dirs, chunksize=10)
+    else:
+        authors_by_instance = [collect_instance_authors(d) for d in tqdm.tqdm(dirs)]
+
+    # reduce step
+    identity_map = {}
+    for authors in authors_by_instance:
+        for author_id in authors:
+            if author_id not in identity_map:
+                identity_map[author_id] = {"name": f"Player {len(identity_map)}", "hash": hash_id(author_id)}
+    return identity_map
+
+
+def save_identity_map(identity_map: dict[str, dict]):
+    IDENTITY_MAP_PATH.parent.mkdir(parents=True, exist_ok=True)
+    with open(IDENTITY_MAP_PATH, "w") as f:
+        json.dump(identity_map, f)
+
+
+_identity_map = None
+
+
+def get_identity_map() -> dict[str, dict]:
+    """Returns this process' (read-only) corpus identity map, loading it from IDENTITY_MAP_PATH on first use."""
+    global _identity_map
+    if _identity_map is None:
+        with open(IDENTITY_MAP_PATH) as f:
+            _identity_map = json.load(f)
+    return _identity_map
+
+
 class AnonInst(Instance):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, identity_map: dict[str, dict] = None, **kwargs):
         super().__init__(*args, **kwargs)
+        self.identity_map = identity_map
         self.author_name_map = {}
         self.id_hash_map = {}
+        self.num_unmapped_authors = 0
+        self._replacers = {}
+
+    def _replacer(self, replace_author_name: bool) -> Callable[[str], str] | None:
+        """Returns the one-pass replacer for IDs (and names), rebuilding it if the maps have grown since it was built."""
+        version = (len(self.author_name_map), len(self.id_hash_map))
+        cached_version, replacer = self._replacers.get(replace_author_name, (None, None))
+        if cached_version != version:
+            if replace_author_name:
+                # names win if a name is also an ID (they were replaced first when replacing one at a time)
+                replacer = build_replacer({**self.id_hash_map, **self.author_name_map})
+            else:
+                replacer = build_replacer(self.id_hash_map)
+            self._replacers[replace_author_name] = (version, replacer)
+        return replacer
 
     def anonymize_recursive(self, obj, replace_author_name=False):
         if isinstance(obj, int):
@@ -42,12 +162,10 @@ class AnonInst(Instance):
             return obj
 
         if isinstance(obj, str):
-            if replace_author_name:
-                for name, replacement in self.author_name_map.items():
-                    obj = obj.replace(name, replacement)
-            for uid, repl in self.id_hash_map.items():
-                obj = obj.replace(uid, repl)
-            return obj
+            replacer = self._replacer(replace_author_name)
+            if replacer is None:
+                return obj
+            return replacer(obj)
 
         if isinstance(obj, list):
             for idx, elem in enumerate(obj):
@@ -66,44 +184,65 @@ class AnonInst(Instance):
 
         return obj
 
+    def collect_author(self, msg) -> str:
+        """Adds the author of a message event to the name/ID maps if they are new and returns their anonymized name."""
+        # anonymize author nick, unless it's Avrae
+        author_id = msg["author_id"]
+        author_name = msg["author_name"]
+        if author_id == AVRAE_ID:
+            self.author_name_map[author_name] = f"Avrae"
+            return "Avrae"
+        elif author_name in self.author_name_map:
+            return self.author_name_map[author_name]
+        if self.identity_map is not None and str(author_id) in self.identity_map:
+            identity = self.identity_map[str(author_id)]
+            self.id_hash_map[author_id] = identity["hash"]
+            self.author_name_map[author_name] = identity["name"]
+        elif self.identity_map is not None:
+            # "Player #" names belong to the identity map, so a stale map must not hand one to a different author
+            log.warning(
+                f"Author {author_id} is not in the corpus identity map (is it stale?), giving them an Unmapped name"
+            )
+            self.id_hash_map[author_id] = hash_id(author_id)
+            self.author_name_map[author_name] = f"Unmapped {self.num_unmapped_authors}"
+            self.num_unmapped_authors += 1
+        else:
+            self.id_hash_map[author_id] = hash_id(author_id)
+            self.author_name_map[author_name] = f"Player {len(self.author_name_map)}"
+        return self.author_name_map[author_name]
+
     def collect_info(self):
         """Removes mentions, emoji, etc; anonymize author names"""
         # collect all the names and IDs
         for msg in self.events:
             if msg["event_type"] != "message":
                 continue
-            content = msg["content"]
-
-            # remove role, channel mentions
-            content = re.sub(r"<@&\d{17,20}>", "<@&role>", content)
-            content = re.sub(r"<#\d{17,20}>", "<#channel>", content)
-
-            # replace user mentions with hash
-            content = re.sub(r"<@!?(\d{17,20})>", lambda m: f"<@{hash_id(m[1])}>", content)
-
-            # replace custom emoji with just their name
-            content = re.sub(r"<a?(:\w+?:)\d{17,20}>", r"\1", content)
-
-            msg["content"] = content
-
-            # anonymize author nick, unless it's Avrae
-            author_id = msg["author_id"]
-            author_name = msg["author_name"]
-            if author_id == AVRAE_ID:
-                self.author_name_map[author_name] = f"Avrae"
-                author_name = "Avrae"
-            elif author_name in self.author_name_map:
-                author_name = self.author_name_map[author_name]
-            else:
-                self.id_hash_map[author_id] = hash_id(author_id)
-                self.author_name_map[author_name] = f"Player {len(self.author_name_map)}"
-                author_name = self.author_name_map[author_name]
-            msg["author_name"] = author_name
+            msg["content"] = clean_message_content(msg["content"])
+            msg["author_name"] = self.collect_author(msg)
 
         # then go over and replace all the names and IDs we found
         for event in self.events:
             self.anonymize_recursive(event)
 
+    def collect_authors(self, messages: Iterable[dict]):
+        """Streaming pass 1: collect all the names and IDs from the message events, without keeping any events."""
+        for msg in messages:
+            self.collect_author(msg)
+
+    def anonymize_raw_event_stream(self, events: Iterable[dict]) -> Iterable[dict]:
+        """
+        Streaming pass 2: given the raw events of an instance whose authors have been collected, yield each event
+        cleaned and anonymized the same way collect_info does.
+        """
+        for event in events:
+            if event["event_type"] == "message":
+                event["content"] = clean_message_content(event["content"])
+                if event["author_id"] == AVRAE_ID:
+                    event["author_name"] = "Avrae"
+                else:
+                    event["author_name"] = self.author_name_map[event["author_name"]]
+            yield self.anonymize_recursive(event)
+
     def anonymize_event_stream(self, events):
         for event in events:
             yield self.anonymize_recursive(event)
@@ -112,14 +251,22 @@ class AnonInst(Instance):
 def anonymize_instance(instance_path: pathlib.Path):
     # collect info from the main instance
     instance_id, *_ = instance_path.stem.split(".")
-    event_stream = utils.combat_dir_iterator(instance_path)
-    inst = AnonInst(event_stream)
-    inst.collect_info()
-
-    # and write all new events to data-anonymized
     (OUT_DIR / "data").mkdir(exist_ok=True)
     (OUT_DIR / "filtered").mkdir(exist_ok=True)
-    utils.write_jsonl(OUT_DIR / "data" / f"{instance_id}.jsonl.gz", inst.events)
+    identity_map = get_identity_map() if CORPUS_IDENTITY_MAP else None
+    if STREAMING:
+        # only one event is in memory at a time: collect from the messages, then rewrite the events as they are read
+        inst = AnonInst([], identity_map=identity_map)
+        inst.collect_authors(message_event_iterator(instance_path))
+        anonymized_events = inst.anonymize_raw_event_stream(utils.combat_dir_iterator(instance_path))
+        utils.write_jsonl(OUT_DIR / "data" / f"{instance_id}.jsonl.gz", anonymized_events)
+    else:
+        event_stream = utils.combat_dir_iterator(instance_path)
+        inst = AnonInst(event_stream, identity_map=identity_map)
+        inst.collect_info()
+
+        # and write all new events to data-anonymized
+        utils.write_jsonl(OUT_DIR / "data" / f"{instance_id}.jsonl.gz", inst.events)
 
     # then anonymize all the experiment4 events
     exp4_data = EXP4_DIR / f"{instance_id}.jsonl"
@@ -134,6 +281,10 @@ if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO, format="%(levelname)s: %(message)s")
     dirs = sorted(utils.get_combat_dirs(DATA_DIR))
     with tqdm.contrib.logging.logging_redirect_tqdm():
+        if CORPUS_IDENTITY_MAP:
+            log.info("Building corpus identity map...")
+            save_identity_map(build_identity_map(dirs))
+            log.info(f"{len(get_identity_map())} authors, saved to {IDENTITY_MAP_PATH}")
         if RUN_PARALLEL:
             tqdm.contrib.concurrent.process_map(anonymize_instance, dirs, chunksize=10)
         else:
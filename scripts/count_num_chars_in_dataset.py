@@ -1,5 +1,5 @@
 """
-Counts the number of characters in message events in the dataset.
+Counts the number of characters and (exact GPT-3) tokens in message events in the dataset.
 This is useful for estimating inference costs with GPT-3.
 """
 import os.path
@@ -12,6 +12,7 @@ import tqdm.contrib.concurrent
 sys.path.append("..")
 
 from dataset import utils
+from token_counts import TokenCounter
 
 DATA_DIR = pathlib.Path(os.path.dirname(__file__), "../data")
 MODEL_COSTS = (
@@ -25,7 +26,17 @@ MODEL_COSTS = (
     ("FT Ada", 0.0016),
 )
 
-Count = namedtuple("Count", "n_chars n_events events commands authors n_actors")
+Count = namedtuple("Count", "n_chars n_tokens n_events events commands authors n_actors")
+
+_token_counter = None
+
+
+def get_token_counter() -> TokenCounter:
+    """Returns this process' token counter, loading the tokenizer on first use."""
+    global _token_counter
+    if _token_counter is None:
+        _token_counter = TokenCounter(cache_path=None)
+    return _token_counter
 
 
 def count(dname):
@@ -35,6 +46,7 @@ def count(dname):
     actors = Counter()  # combatant id -> number of characters
     n_chars = 0
     n_events = 0
+    contents = []
 
     for event in utils.combat_dir_iterator(dname):
         n_events += 1
@@ -43,6 +55,7 @@ def count(dname):
             msg_len = len(event["content"])
             n_chars += msg_len
             authors[event["author_id"]] += msg_len
+            contents.append(event["content"])
         elif event["event_type"] == "command":
             commands[event["command_name"]] += 1
         elif event["event_type"] == "combat_state_update":
@@ -54,6 +67,7 @@ def count(dname):
 
     return Count(
         n_chars=n_chars,
+        n_tokens=int(get_token_counter().count(contents).sum()),
         n_events=n_events,
         events=events,
         commands=commands,
@@ -75,6 +89,7 @@ def main():
     total_chars = sum(c.n_chars for c in counts)
     total_n_events = sum(c.n_events for c in counts)
     total_actors = sum(c.n_actors for c in counts)
+    token_count = sum(c.n_tokens for c in counts)
 
     print(
         f"total number of characters: {total_chars}\n"
@@ -86,9 +101,7 @@ def main():
         f"unique actors: {total_actors}"
     )
 
-    token_count = total_chars / 4
-
-    print(f"Total number of characters: {total_chars} (approx. {token_count} tokens)")
+    print(f"Total number of characters: {total_chars} ({token_count} tokens)")
     for model_name, cost_per_1k in MODEL_COSTS:
         print(f"{model_name}: ${token_count / 1000 * cost_per_1k:.2f}")
 
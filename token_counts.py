@@ -0,0 +1,132 @@
+"""
+Exact token accounting for fine-tune files using the GPT-2/GPT-3 BPE tokenizer.
+
+Token counts are cached on disk by a hash of the text, so re-counting a file that mostly contains prompts seen before
+only tokenizes the new ones.
+
+Usage: python token_counts.py extract/ft-utt-cmd-train-30000.jsonl [extract/ft-sta-nar-train-20000.jsonl ...]
+"""
+import argparse
+import hashlib
+import pathlib
+import sqlite3
+from typing import Iterable
+
+import numpy as np
+from transformers import GPT2TokenizerFast
+
+from dataset.utils import AnyPath, read_jsonl_file
+
+TOKEN_CACHE_PATH = pathlib.Path("extract/token_counts.sqlite3")
+TOKENIZER_NAME = "gpt2"  # GPT-3 base models use the same BPE as GPT-2
+MAX_CONTEXT_TOKENS = 2048
+HISTOGRAM_BINS = (0, 128, 256, 512, 768, 1024, 1536, 2048, np.inf)
+DAVINCI_FT_PRICE = 0.03 / 1000
+
+
+def _digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+class TokenCounter:
+    """Counts tokens in batches, caching counts by content hash in a SQLite DB (or only in memory if no path)."""
+
+    def __init__(self, cache_path: AnyPath | None = TOKEN_CACHE_PATH, batch_size: int = 1000):
+        self.batch_size = batch_size
+        self.tokenizer = GPT2TokenizerFast.from_pretrained(TOKENIZER_NAME)
+        if cache_path is None:
+            self.db = sqlite3.connect(":memory:")
+        else:
+            pathlib.Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+            self.db = sqlite3.connect(cache_path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS token_counts (digest BLOB PRIMARY KEY, n_tokens INTEGER)")
+
+    def _lookup(self, digests: list[bytes]) -> dict[bytes, int]:
+        found = {}
+        # stay under SQLite's bound parameter limit
+        for start in range(0, len(digests), 500):
+            chunk = digests[start : start + 500]
+            placeholders = ",".join("?" * len(chunk))
+            rows = self.db.execute(f"SELECT digest, n_tokens FROM token_counts WHERE digest IN ({placeholders})", chunk)
+            found.update(rows)
+        return found
+
+    def count(self, texts: list[str]) -> np.ndarray:
+        """Returns the number of tokens in each text, in the order given."""
+        digests = [_digest(text) for text in texts]
+        counts = self._lookup(list(set(digests)))
+
+        # tokenize each distinct missing text once, in large batches
+        misses = {}
+        for digest, text in zip(digests, texts):
+            if digest not in counts:
+                misses[digest] = text
+        miss_digests = list(misses)
+        for start in range(0, len(miss_digests), self.batch_size):
+            batch_digests = miss_digests[start : start + self.batch_size]
+            encoded = self.tokenizer([misses[d] for d in batch_digests], add_special_tokens=False)["input_ids"]
+            new_counts = {d: len(ids) for d, ids in zip(batch_digests, encoded)}
+            self.db.executemany("INSERT OR REPLACE INTO token_counts VALUES (?, ?)", new_counts.items())
+            counts.update(new_counts)
+        self.db.commit()
+
+        return np.fromiter((counts[d] for d in digests), dtype=np.int64, count=len(digests))
+
+    def close(self):
+        self.db.close()
+
+
+# ===== reporting =====
+def pair_token_report(
+    name: str,
+    pairs: Iterable[dict],
+    counter: TokenCounter,
+    train_epochs: int = 1,
+    max_context: int = MAX_CONTEXT_TOKENS,
+) -> str:
+    """
+    Given an iterable of {"prompt": str, "completion": str} pairs, return a printable report of the exact token totals,
+    a histogram of total lengths, the number of pairs longer than the context window, and the finetune cost.
+    """
+    prompts = []
+    completions = []
+    for pair in pairs:
+        prompts.append(pair["prompt"])
+        completions.append(pair["completion"])
+    if not prompts:
+        return f"{name}: no pairs"
+
+    prompt_tokens = counter.count(prompts)
+    completion_tokens = counter.count(completions)
+    total_tokens = prompt_tokens + completion_tokens
+    hist, edges = np.histogram(total_tokens, bins=HISTOGRAM_BINS)
+    n_over = int((total_tokens > max_context).sum())
+
+    lines = [
+        f"{name}: {len(prompts)} pairs",
+        f"  prompt tokens: {prompt_tokens.sum()} (mean {prompt_tokens.mean():.1f}, max {prompt_tokens.max()})",
+        f"  completion tokens: {completion_tokens.sum()} (mean {completion_tokens.mean():.1f},"
+        f" max {completion_tokens.max()})",
+        f"  over {max_context} tokens: {n_over} ({n_over / len(prompts):.2%})",
+        "  length histogram (prompt + completion):",
+    ]
+    for lo, hi, n in zip(edges, edges[1:], hist):
+        label = f"{int(lo)}-{int(hi) - 1}" if hi != np.inf else f"{int(lo)}+"
+        lines.append(f"    {label:>10}: {n}")
+    lines.append(
+        f"  Davinci finetune cost ({train_epochs} epochs): ${total_tokens.sum() * DAVINCI_FT_PRICE * train_epochs:.2f}"
+    )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reports exact token counts for prompt/completion JSONL files.")
+    parser.add_argument("files", nargs="+", type=pathlib.Path)
+    parser.add_argument("--epochs", help="the number of finetune epochs to estimate cost for", default=1, type=int)
+    parser.add_argument("--max-context", help="the context window size", default=MAX_CONTEXT_TOKENS, type=int)
+    args = parser.parse_args()
+
+    token_counter = TokenCounter()
+    for fp in args.files:
+        print(pair_token_report(fp.stem, read_jsonl_file(fp), token_counter, args.epochs, args.max_context))
+    token_counter.close()
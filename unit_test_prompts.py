@@ -65,6 +65,7 @@ def main():
         print(dirpath)
         scenario = UnitTestScenario(dirpath)
         scenario.create_prompt()
+    print(f"actor render cache: {prompts.actor_render_cache_info()}")
 
 
 if __name__ == "__main__":